@@ -0,0 +1,4 @@
+# Allows `python -m esp32_micropython`
+from .dm import main
+
+main()
@@ -13,23 +13,29 @@ Usage:
 from pathlib import Path
 import json
 import os
+import stat
 import subprocess
 import argparse
 import sys
-import serial.tools.list_ports
-import urllib.request
-import tempfile
-import shutil
 import re # Added for parsing stat output
+import ast
 import time # Added for delays
+import functools
+import atexit
+from types import SimpleNamespace
 
 CONFIG_FILE = Path(__file__).parent / ".esp32_deploy_config.json"
+_CONFIG_FILE_STR = str(CONFIG_FILE) # Plain string path for the config I/O done on every invocation
 DEVICE_PORT = None # Will be set by main after parsing args or loading config
 DEFAULT_FIRMWARE_URL = "https://micropython.org/resources/firmware/ESP32_GENERIC_C3-20250415-v1.25.0.bin"
+FIRMWARE_MEMORY_BUFFER_LIMIT = 8 * 1024 * 1024 # Downloads up to this size are buffered in memory and written once
+DEFAULT_FLASH_BAUD = "921600" # Used when neither --baud nor a saved "baud" config value is given
+FALLBACK_FLASH_BAUD = "460800" # A failed write at a higher baud rate is retried once at this one
 
 # Constants for file modes (from uos.stat results)
 S_IFDIR = 0x4000  # Directory
 S_IFREG = 0x8000  # Regular file
+_STAT_MODE_RE = re.compile(r"\(\s*(-?\d+)\s*,")  # First field (st_mode) of a printed uos.stat tuple
 
 # Constants for file operations and timeouts
 FS_OPERATION_DELAY = 0.3  # Delay in seconds between filesystem operations on the ESP32
@@ -40,23 +46,134 @@ MP_TIMEOUT_MKDIR = 15
 MP_TIMEOUT_CP_FILE = 120  # Timeout for copying a single file
 MP_TIMEOUT_RM = 60        # Timeout for mpremote fs rm -r
 MP_TIMEOUT_DF = 10
-
-def load_config():
-    if CONFIG_FILE.exists():
+MP_TIMEOUT_PROBE = 8      # Per-port timeout when probing candidate ports in parallel
+PROBE_MAX_WORKERS = 3
+REBOOT_WAIT_BUDGET = 15   # Seconds a freshly flashed device gets to answer as MicroPython
+REBOOT_POLL_INTERVAL = 0.25
+RUN_SCRIPT_OPEN_MARKER = "__dm_run_open__" # Tags the error `run` raises when the script itself cannot be opened
+ASYNC_LOW_LATENCY = 1 << 13 # Linux serial_struct flag (linux/tty_flags.h)
+PORT_LIST_CACHE_TTL = 2   # Seconds a serial port enumeration is reused for
+ESP32_USB_VIDPIDS = frozenset({
+    (0x10C4, 0xEA60), # Silicon Labs CP210x
+    (0x1A86, 0x7523), # WCH CH340
+    (0x1A86, 0x55D4), # WCH CH9102
+    (0x0403, 0x6001), # FTDI FT232R
+    (0x303A, 0x1001), # Espressif USB-Serial/JTAG (ESP32-C3/S3 native USB)
+    (0x303A, 0x1002), # Espressif USB CDC
+})
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "esp32_micropython")
+PORTS_CACHE_FILE = os.path.join(CACHE_DIR, "ports.json")
+TEST_DEVICE_CACHE_FILE = os.path.join(CACHE_DIR, "test_device.json")
+TEST_DEVICE_CACHE_TTL = 10 # Seconds a device test result is reused for by 'esp32 device'
+FIRMWARE_CACHE_DIR = os.path.join(CACHE_DIR, "firmware") # Downloaded images, revalidated with conditional GETs
+PORT_INFO_FIELDS = ("device", "description", "hwid", "vid", "pid", "serial_number") # ListPortInfo attributes kept in the cache
+MP_BATCH_SIZE = 32        # Max number of commands chained into a single mpremote invocation
+MP_RETRY_ATTEMPTS = 3     # Tries for idempotent filesystem commands (fs cp, mkdir) before giving up
+MP_RETRY_BASE_DELAY = 0.1 # Seconds before the first retry; doubles on each further one
+# mpremote messages for failures that happen before or outside the device's Python (worth retrying)
+MP_TRANSPORT_FAILURE_MARKERS = ("failed to access", "could not enter raw repl", "SerialException")
+ESPTOOL_FLASH_COMMANDS = ("write_flash", "erase_flash")
+# Captured children never need a console window; skipping its allocation makes each spawn cheaper on Windows.
+# Streaming runs keep the default so their output still reaches the user's console.
+_CAPTURED_SPAWN_KW = {"creationflags": subprocess.CREATE_NO_WINDOW} if os.name == "nt" else {}
+
+# Local entries `upload --skip-dev-files` leaves out of a directory upload (plus anything starting with '.', e.g. .git)
+UPLOAD_SKIP_NAMES = frozenset({"__pycache__", CONFIG_FILE.name})
+UPLOAD_SKIP_SUFFIXES = (".egg-info",)
+
+# In-process cache of remote path types, so repeated lookups don't each cost an mpremote run
+_REMOTE_STAT_CACHE = {}          # Normalized remote path ("" for root) -> "file", "dir", "unknown" or None (missing)
+_STAT_CACHE_PRIMED_DIRS = set()  # Remote directories whose entries are all present in _REMOTE_STAT_CACHE
+_CFG = None # Config as read by load_config(); the file doesn't change under a running command
+
+def _read_config():
+    if os.path.exists(_CONFIG_FILE_STR):
         try:
-            return json.loads(CONFIG_FILE.read_text())
-        except json.JSONDecodeError:
+            with open(_CONFIG_FILE_STR, "rb") as f:
+                return json.load(f)
+        except ValueError: # JSONDecodeError, or bytes that aren't valid UTF-8
             print(f"Warning: Config file {CONFIG_FILE} is corrupted. Using defaults.", file=sys.stderr)
     return {}
 
+def load_config():
+    global _CFG
+    if _CFG is None:
+        _CFG = _read_config()
+    return _CFG
+
 def save_config(cfg):
+    global _CFG
+    _CFG = None
+    # Write to a sibling temp file and swap it in, so an interrupted save never leaves a truncated config
+    tmp_config_file = _CONFIG_FILE_STR + ".tmp"
     try:
-        CONFIG_FILE.write_text(json.dumps(cfg, indent=2))
+        with open(tmp_config_file, "wb") as f:
+            f.write(json.dumps(cfg, separators=(",", ":")).encode())
+        os.replace(tmp_config_file, _CONFIG_FILE_STR)
     except IOError as e:
         print(f"Error saving config file {CONFIG_FILE}: {e}", file=sys.stderr)
 
+def write_cache_file(cache_file, data):
+    """Atomically writes data as JSON to a file under CACHE_DIR. Caching is best effort, so errors are ignored."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_file + ".tmp", "wb") as f:
+            f.write(json.dumps(data, separators=(",", ":")).encode())
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError:
+        pass
+
+@functools.lru_cache(maxsize=1)
+def _list_ports_cached(time_bucket):
+    # Back-to-back CLI runs (scripts, shell loops) share the enumeration through a small on-disk cache
+    try:
+        if time.time() - os.path.getmtime(PORTS_CACHE_FILE) < PORT_LIST_CACHE_TTL:
+            with open(PORTS_CACHE_FILE, "rb") as f:
+                return tuple(SimpleNamespace(**port_fields) for port_fields in json.load(f))
+    except (OSError, ValueError, TypeError):
+        pass
+    import serial.tools.list_ports # Deferred: loads the platform USB backends, which most commands never need
+    ports = tuple(SimpleNamespace(**{field: getattr(p, field, None) for field in PORT_INFO_FIELDS}) for p in serial.tools.list_ports.comports())
+    write_cache_file(PORTS_CACHE_FILE, [vars(p) for p in ports])
+    return ports
+
 def list_ports():
-    return list(serial.tools.list_ports.comports())
+    """Lists serial ports, reusing the enumeration for up to PORT_LIST_CACHE_TTL seconds."""
+    return list(_list_ports_cached(int(time.monotonic() / PORT_LIST_CACHE_TTL)))
+
+def _decode(process):
+    """Decodes a captured process's output once, tolerating stray bytes from the device."""
+    process.stdout = process.stdout.decode("utf-8", "replace").replace("\r\n", "\n") if process.stdout else ""
+    process.stderr = process.stderr.decode("utf-8", "replace").replace("\r\n", "\n") if process.stderr else ""
+    return process
+
+@functools.lru_cache(maxsize=None)
+def set_serial_low_latency(port):
+    """
+    Best effort: sets ASYNC_LOW_LATENCY on a Linux serial port (as `setserial <port> low_latency` does), which
+    drops the FTDI latency timer from 16 ms to 1 ms and so shortens every mpremote/esptool round trip.
+    Drivers without TIOCSSERIAL support (e.g. CP210x, CDC-ACM) just keep their defaults. Done once per port.
+    Opt-in with ESP32_LOW_LATENCY=1: opening the tty for the ioctl can toggle DTR/RTS, which resets boards
+    with an auto-reset circuit, and only FTDI-style drivers gain anything.
+    Returns True if the port is in low-latency mode.
+    """
+    if not sys.platform.startswith("linux") or os.environ.get("ESP32_LOW_LATENCY") != "1": return False
+    import array, fcntl, termios
+    try:
+        fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        serial_info = array.array("i", [0] * 32) # struct serial_struct; flags is its 5th int
+        fcntl.ioctl(fd, termios.TIOCGSERIAL, serial_info)
+        if not serial_info[4] & ASYNC_LOW_LATENCY:
+            serial_info[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(fd, termios.TIOCSSERIAL, serial_info)
+        return True
+    except (OSError, AttributeError): # AttributeError: termios without TIOCGSERIAL
+        return False
+    finally:
+        os.close(fd)
 
 def run_mpremote_command(mpremote_args_list, connect_port=None, suppress_output=False, timeout=None, working_dir=None):
     global DEVICE_PORT
@@ -65,44 +182,267 @@ def run_mpremote_command(mpremote_args_list, connect_port=None, suppress_output=
         print("Error: Device port not set for mpremote command.", file=sys.stderr)
         return subprocess.CompletedProcess(mpremote_args_list, -99, stdout="", stderr="Device port not set")
 
+    close_mpremote_session() # mpremote opens the port exclusively
+    set_serial_low_latency(port_to_use)
     base_cmd = ["mpremote", "connect", port_to_use]
     full_cmd = base_cmd + mpremote_args_list
     # print(f"DEBUG: Running mpremote: {' '.join(full_cmd)}", file=sys.stderr)
 
     try:
         if suppress_output:
-            process = subprocess.run(full_cmd, capture_output=True, text=True, check=False, timeout=timeout, cwd=working_dir)
+            process = _decode(subprocess.run(full_cmd, capture_output=True, check=False, timeout=timeout, cwd=working_dir, **_CAPTURED_SPAWN_KW))
         else:
-            process = subprocess.run(full_cmd, text=True, check=False, timeout=timeout, cwd=working_dir)
+            process = subprocess.run(full_cmd, check=False, timeout=timeout, cwd=working_dir)
         return process
     except FileNotFoundError:
         print("Error: mpremote command not found. Is it installed and in PATH?", file=sys.stderr)
         sys.exit(1)
-    except subprocess.TimeoutExpired:
-        return subprocess.CompletedProcess(full_cmd, -1, stdout="", stderr=f"TimeoutExpired ({timeout}s) executing mpremote")
+    except subprocess.TimeoutExpired as e:
+        # Keep what was captured before the timeout, so batch callers can tell which copies finished
+        stdout = e.stdout.decode("utf-8", "replace").replace("\r\n", "\n") if e.stdout else ""
+        return subprocess.CompletedProcess(full_cmd, -1, stdout=stdout, stderr=f"TimeoutExpired ({timeout}s) executing mpremote")
     except Exception as e:
         return subprocess.CompletedProcess(full_cmd, -2, stdout="", stderr=f"Unexpected error: {e}")
 
+def run_mpremote_batch(command_groups, connect_port=None, suppress_output=True, timeout=None, working_dir=None):
+    """
+    Runs several mpremote commands in a single mpremote session by chaining them with '+'.
+    command_groups: list of mpremote argument lists, e.g. [["fs", "cp", "a", ":a"], ["fs", "cp", "b", ":b"]]
+    mpremote stops at the first failing command, so the returned process describes the whole chain.
+    """
+    chained_args = []
+    for group in command_groups:
+        if chained_args:
+            chained_args.append("+")
+        chained_args.extend(group)
+    return run_mpremote_command(chained_args, connect_port=connect_port, suppress_output=suppress_output, timeout=timeout, working_dir=working_dir)
+
+def is_transport_failure(result):
+    """
+    True if a failed mpremote run or session exec failed on the way to the device (a port that couldn't be
+    opened, a lost connection), so running it again may succeed. An exception raised by the device's Python
+    is not one: the same command would fail the same way. Neither is a timeout, which usually means a
+    legitimately slow operation; retrying it would only multiply the wait before the error is shown.
+    """
+    if not result or result.returncode in (0, -99):
+        return False
+    stderr = result.stderr or ""
+    if "timeout" in stderr.lower(): # mpremote subprocess timeouts and the session's read timeouts
+        return False
+    if result.returncode == -1: # The session's connection failed
+        return True
+    return any(marker in stderr for marker in MP_TRANSPORT_FAILURE_MARKERS)
+
+def run_with_retry(run, attempts=MP_RETRY_ATTEMPTS, base_delay=MP_RETRY_BASE_DELAY):
+    """
+    Calls run(), which returns a CompletedProcess, while it fails with a transport failure (see
+    is_transport_failure) and attempts remain, backing off exponentially in between. Only for idempotent
+    filesystem commands (fs cp, mkdir); never for user scripts.
+    """
+    for attempt in range(attempts):
+        result = run()
+        if not is_transport_failure(result):
+            return result
+        if attempt < attempts - 1:
+            time.sleep(base_delay * 2 ** attempt)
+    return result
+
+class MpRemoteSession:
+    """
+    A raw REPL connection to the device that stays open across exec calls, using mpremote's own
+    serial transport in-process instead of spawning `mpremote exec` (process start, serial open and
+    REPL entry) for every snippet.
+    mpremote.transport_serial is not a public API, so mpremote is pinned to the version this was written
+    against (1.25.0). If the module or the methods used here are missing, opening the session fails and
+    run_mpremote_exec falls back to `mpremote exec` subprocesses.
+    """
+    def __init__(self, port):
+        from mpremote.transport_serial import SerialTransport
+        if not all(hasattr(SerialTransport, name) for name in ("enter_raw_repl", "exec_raw", "exit_raw_repl", "close")):
+            raise ImportError("Unsupported mpremote SerialTransport")
+        self.port = port
+        set_serial_low_latency(port)
+        self.transport = SerialTransport(port, baudrate=115200)
+        try:
+            self.transport.enter_raw_repl(soft_reset=True) # Same fresh state `mpremote exec` starts from
+        except BaseException:
+            self.transport.close()
+            raise
+
+    def exec(self, code, timeout=None, data_consumer=None):
+        """
+        Runs code on the device. Returns a CompletedProcess shaped like a captured `mpremote exec` run.
+        timeout: unlike the subprocess timeout of run_mpremote_command, this is how long the device may stay
+        silent (mpremote's exec_raw restarts it on every character received), not a limit on the whole call.
+        None waits indefinitely.
+        data_consumer: called with each chunk of stdout as it arrives, e.g. to stream a long-running script.
+        """
+        try:
+            stdout, stderr = self.transport.exec_raw(code, timeout=timeout, data_consumer=data_consumer)
+        except Exception as e:
+            return subprocess.CompletedProcess(["exec", code], -1, stdout="", stderr=f"Session error: {e}")
+        return _decode(subprocess.CompletedProcess(["exec", code], 1 if stderr else 0, stdout=stdout, stderr=stderr))
+
+    def close(self):
+        try:
+            self.transport.exit_raw_repl()
+        except Exception:
+            pass
+        self.transport.close()
+
+_MP_SESSION = None
+_MP_SESSION_FAILED_PORTS = set() # Ports the session couldn't be opened on; those keep using mpremote subprocesses
+
+def close_mpremote_session():
+    """Closes the shared session, e.g. before something else (mpremote, esptool) needs the serial port."""
+    global _MP_SESSION
+    if _MP_SESSION:
+        _MP_SESSION.close()
+        _MP_SESSION = None
+
+atexit.register(close_mpremote_session)
+
+def open_mpremote_session(port):
+    """
+    Returns the shared MpRemoteSession for port, opening it (and closing one on another port) if needed.
+    Returns None if the session can't be used on that port; callers then fall back to mpremote subprocesses.
+    """
+    global _MP_SESSION
+    if not port or port in _MP_SESSION_FAILED_PORTS:
+        return None
+    if _MP_SESSION and _MP_SESSION.port != port:
+        close_mpremote_session()
+    if not _MP_SESSION:
+        try:
+            _MP_SESSION = MpRemoteSession(port)
+        except Exception:
+            _MP_SESSION_FAILED_PORTS.add(port)
+    return _MP_SESSION
+
+def _write_stdout_bytes(data):
+    sys.stdout.buffer.write(data.replace(b"\x04", b""))
+    sys.stdout.buffer.flush()
+
+def run_mpremote_exec(code, connect_port=None, timeout=None, use_session=True, stream=False):
+    """
+    Runs a snippet on the device with its output captured, through the shared MpRemoteSession when it can
+    be opened and with `mpremote exec` otherwise.
+    timeout: seconds of device silence on the session path, total run time on the mpremote path (see MpRemoteSession.exec).
+    use_session: False to always spawn mpremote, e.g. from worker threads (the shared session isn't thread-safe).
+    stream: True to print stdout as it arrives instead of capturing it (stderr is still captured by the session;
+    the mpremote fallback prints both and captures nothing).
+    """
+    port_to_use = connect_port or DEVICE_PORT
+    session = open_mpremote_session(port_to_use) if use_session else None
+    if session:
+        result = session.exec(code, timeout=timeout, data_consumer=_write_stdout_bytes if stream else None)
+        if result.returncode == -1:
+            close_mpremote_session() # Connection is in an unknown state; reopen on next use
+        return result
+    return run_mpremote_command(["exec", code], connect_port=port_to_use, suppress_output=not stream, timeout=timeout)
+
+def esptool_flash_defaults(esptool_args_list):
+    """
+    Returns the esptool global options a flashing command should run with but doesn't already set:
+    target chip, a high baud rate (ESPBAUD environment variable, as in ESP-IDF) and reset behaviour.
+    """
+    defaults = [
+        ("--chip", "esp32c3"),
+        ("--baud", os.environ.get("ESPBAUD", DEFAULT_FLASH_BAUD)),
+        ("--before", "default_reset"),
+        ("--after", "hard_reset"),
+    ]
+    missing_options = []
+    for option, value in defaults:
+        if option not in esptool_args_list:
+            missing_options += [option, value]
+    return missing_options
+
 def run_esptool_command(esptool_args_list, suppress_output=False, timeout=None, working_dir=None):
-    base_cmd = ["esptool"]
-    full_cmd = base_cmd + esptool_args_list
+    """
+    Runs esptool as a `python -m esptool` subprocess, so the timeout covers the whole run and a failed
+    operation can't leave the serial port open in this process.
+    """
+    esptool_argv = []
+    if any(flash_cmd in esptool_args_list for flash_cmd in ESPTOOL_FLASH_COMMANDS):
+        esptool_argv += esptool_flash_defaults(esptool_args_list)
+    esptool_argv += esptool_args_list
+    full_cmd = [sys.executable, "-m", "esptool"] + esptool_argv # The esptool installed alongside this package, whatever its script is called
+    close_mpremote_session() # esptool needs the serial port to itself
+    if "--port" in esptool_args_list[:-1]:
+        set_serial_low_latency(esptool_args_list[esptool_args_list.index("--port") + 1])
     try:
         if suppress_output:
-            process = subprocess.run(full_cmd, capture_output=True, text=True, check=False, timeout=timeout, cwd=working_dir)
+            process = _decode(subprocess.run(full_cmd, capture_output=True, check=False, timeout=timeout, cwd=working_dir, **_CAPTURED_SPAWN_KW))
         else:
-            process = subprocess.run(full_cmd, text=True, check=False, timeout=timeout, cwd=working_dir)
+            process = subprocess.run(full_cmd, check=False, timeout=timeout, cwd=working_dir)
         return process
     except FileNotFoundError:
-        print("Error: esptool command not found. Is it installed and in PATH? (esptool is required for flashing).", file=sys.stderr)
+        print(f"Error: could not run esptool with {sys.executable}. esptool must be installed for this Python interpreter (esptool is required for flashing).", file=sys.stderr)
+        print("You can install it with: pip install esptool")
         sys.exit(1) 
     except subprocess.TimeoutExpired:
         return subprocess.CompletedProcess(full_cmd, -1, stdout="", stderr=f"TimeoutExpired ({timeout}s) executing esptool")
     except Exception as e:
         return subprocess.CompletedProcess(full_cmd, -2, stdout="", stderr=f"Unexpected error: {e}")
 
+def _mode_to_path_type(mode):
+    if (mode & S_IFDIR) == S_IFDIR: return "dir"
+    elif (mode & S_IFREG) == S_IFREG: return "file"
+    else: return "unknown"
+
+def _prime_stat_cache(parent=""):
+    """
+    Lists a remote directory with a single `mpremote exec` and caches the type of every entry.
+    parent: Path string relative to root (e.g., "lib", "" for root)
+    Returns the directory's (name, mode) entries, or None if it couldn't be listed.
+    """
+    parent_norm = (parent or "").strip().strip("/")
+    path_for_uos = f"/{parent_norm}"
+    escaped_path_for_uos = path_for_uos.replace("'", "\\'")
+    code = f"import uos, ujson; print(ujson.dumps([(e[0], e[1]) for e in uos.ilistdir('{escaped_path_for_uos}')]))"
+
+    result = run_mpremote_exec(code, timeout=MP_TIMEOUT_EXEC)
+    if result and result.stderr and ("ENOENT" in result.stderr or "No such file or directory" in result.stderr):
+        _REMOTE_STAT_CACHE[parent_norm] = None # Known to be missing
+        return None
+    if not result or result.returncode != 0 or not result.stdout:
+        return None
+    try:
+        entries = json.loads(result.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return None
+
+    prefix = f"{parent_norm}/" if parent_norm else ""
+    for name, mode in entries:
+        _REMOTE_STAT_CACHE[prefix + name] = _mode_to_path_type(mode)
+    _REMOTE_STAT_CACHE[parent_norm] = "dir"
+    _STAT_CACHE_PRIMED_DIRS.add(parent_norm)
+    return entries
+
+def _cache_remote_path(remote_path, path_type):
+    """
+    Records a remote path this script just created ("file"/"dir") or deleted (None),
+    forgetting everything cached below it.
+    """
+    key = remote_path.lstrip(":").strip("/")
+    prefix = f"{key}/" if key else ""
+    for cached_key in [k for k in _REMOTE_STAT_CACHE if k == key or k.startswith(prefix)]:
+        del _REMOTE_STAT_CACHE[cached_key]
+    _STAT_CACHE_PRIMED_DIRS.difference_update([d for d in _STAT_CACHE_PRIMED_DIRS if d == key or d.startswith(prefix)])
+    if path_type:
+        _REMOTE_STAT_CACHE[key] = path_type
+
+def _invalidate_remote_path(remote_path):
+    """Drops cached knowledge about a remote path whose state is unknown, e.g. after a failed command."""
+    _cache_remote_path(remote_path, None)
+    _STAT_CACHE_PRIMED_DIRS.discard(remote_path.lstrip(":").strip("/").rpartition("/")[0])
+
 def get_remote_path_stat(target_path_on_device):
     """
-    Gets the type ('file', 'dir', 'unknown', or None) of a remote path using `mpremote exec uos.stat()`.
+    Gets the type ('file', 'dir', 'unknown', or None) of a remote path.
+    Answers come from _REMOTE_STAT_CACHE, which is filled by listing the parent directory once;
+    falls back to `mpremote exec uos.stat()` when the parent can't be listed.
     target_path_on_device: Path string relative to root (e.g., "main.py", "lib/foo", "")
     Returns a string: "file", "dir", "unknown", or None if not found/error.
     """
@@ -110,6 +450,18 @@ def get_remote_path_stat(target_path_on_device):
     if not DEVICE_PORT:
         return None
 
+    cache_key = (target_path_on_device or "").strip().strip("/")
+    if cache_key in _REMOTE_STAT_CACHE:
+        return _REMOTE_STAT_CACHE[cache_key]
+    if cache_key:
+        parent_key = cache_key.rpartition("/")[0]
+        if parent_key in _REMOTE_STAT_CACHE and _REMOTE_STAT_CACHE[parent_key] != "dir":
+            return None # Parent is missing or not a directory
+        if parent_key in _STAT_CACHE_PRIMED_DIRS or _prime_stat_cache(parent_key) is not None:
+            return _REMOTE_STAT_CACHE.get(cache_key)
+        if _REMOTE_STAT_CACHE.get(parent_key, "dir") != "dir":
+            return None
+
     if not target_path_on_device or target_path_on_device.strip() == "/":
         path_for_uos = "/"
     else:
@@ -118,59 +470,125 @@ def get_remote_path_stat(target_path_on_device):
     escaped_path_for_uos = path_for_uos.replace("'", "\\'")
     code = f"import uos; print(uos.stat('{escaped_path_for_uos}'))"
     
-    result = run_mpremote_command(["exec", code], suppress_output=True, timeout=MP_TIMEOUT_EXEC)
+    result = run_mpremote_exec(code, timeout=MP_TIMEOUT_EXEC)
 
     if result and result.returncode == 0 and result.stdout:
         stat_tuple_str = result.stdout.strip()
+        # Only the mode (first field) is used, so avoid parsing the whole tuple when possible.
+        # literal_eval rejects anything that isn't a literal, so unexpected output needs no pre-check.
+        mode_match = _STAT_MODE_RE.match(stat_tuple_str)
         try:
-            if stat_tuple_str.startswith("(") and stat_tuple_str.endswith(")"):
-                numbers = re.findall(r'-?\d+', stat_tuple_str)
-                if not numbers: return None
-                mode = int(numbers[0])
-                if (mode & S_IFDIR) == S_IFDIR: return "dir"
-                elif (mode & S_IFREG) == S_IFREG: return "file"
-                else: return "unknown"
-            else: return None
-        except (IndexError, ValueError): return None
+            mode = int(mode_match.group(1)) if mode_match else int(ast.literal_eval(stat_tuple_str)[0])
+        except (ValueError, SyntaxError, TypeError, IndexError): return None # TypeError/IndexError: a literal, but not a tuple
+        _REMOTE_STAT_CACHE[cache_key] = _mode_to_path_type(mode)
+        return _REMOTE_STAT_CACHE[cache_key]
     elif result and result.stderr and ("ENOENT" in result.stderr or "No such file or directory" in result.stderr):
         return None 
     
     return None
 
 
-def cmd_devices():
+def partition_ports(ports):
+    """Splits ports into (likely, other): likely ports have the USB VID:PID of a common ESP32 USB-serial bridge."""
+    likely, other = [], []
+    for p in ports:
+        (likely if (p.vid, p.pid) in ESP32_USB_VIDPIDS else other).append(p)
+    return likely, other
+
+def cmd_devices(show_all=False):
     cfg = load_config()
     selected_port = cfg.get("port")
-    available_ports = list_ports()
-    if not available_ports:
+    devices = {p.device: p for p in list_ports()}
+    if not devices:
         print("No serial ports found.")
         return
 
+    likely, other = partition_ports(devices.values())
+    # Unrelated ports (built-in UARTs, Bluetooth, modems) are hidden unless asked for, or unless nothing looks like an ESP32
+    shown_ports = list(devices.values()) if show_all or not likely else likely + [p for p in other if p.device == selected_port]
     print("Available COM ports:")
-    for p in available_ports:
+    for p in shown_ports:
         marker = "*" if p.device == selected_port else ""
         print(f"  {marker}{p.device}{marker} - {p.description}")
+    if len(shown_ports) < len(devices):
+        print(f"  ({len(devices) - len(shown_ports)} other port(s) hidden, use 'esp32 devices --all' to show them)")
 
-    if selected_port and selected_port not in [p.device for p in available_ports]:
+    if selected_port and selected_port not in devices:
         print(f"\nWarning: The selected COM port '{selected_port}' is not available. Please reconfigure.")
     elif not selected_port:
-        print(f"\nNo COM port selected. Use 'esp32 device <PORT_NAME>' to set one.")
+        print("\nNo COM port selected. Use 'esp32 device <PORT_NAME>' to set one.")
     else:
         print(f"\nSelected COM port: {selected_port} (use 'esp32 device <PORT_NAME>' to change it).")
 
-def test_device(port, timeout=MP_TIMEOUT_LS_MPREMOTE): # Using direct mpremote ls for test
-    result = run_mpremote_command(["fs", "ls", ":"], connect_port=port, suppress_output=True, timeout=timeout)
+def probe_device(port, timeout=MP_TIMEOUT_EXEC, use_session=True):
+    """
+    Checks in a single `mpremote exec` that a device responds and runs MicroPython. The snippet only reports
+    the implementation, so the check needs no filesystem access on the device and little serial traffic.
+    Returns (responsive, is_micropython, details): details is the MicroPython version when MicroPython answered,
+    otherwise a string with the error or the unexpected output.
+    """
+    code_to_run = "import sys; print(sys.implementation.name, '.'.join(str(v) for v in sys.implementation.version[:3]))"
+    result = run_mpremote_exec(code_to_run, connect_port=port, timeout=timeout, use_session=use_session)
     time.sleep(FS_OPERATION_DELAY / 2) 
-    if result and result.returncode == 0:
-        return True, f"Device on {port} responded (mpremote fs ls successful)."
-    else:
+
+    if not result or result.returncode != 0:
+        if result and result.returncode == -99: return False, False, result.stderr
         err_msg = result.stderr.strip() if result and result.stderr else "No response or mpremote error."
-        if result and result.returncode == -99: err_msg = result.stderr 
+        return False, False, err_msg
+
+    implementation, _, version = (result.stdout or "").strip().partition(" ")
+    if implementation.lower() != "micropython":
+        return True, False, result.stdout.strip() if result.stdout else "No output."
+    return True, True, version
+
+def test_device(port, timeout=MP_TIMEOUT_LS_MPREMOTE, use_session=True):
+    responsive, is_micropython, details = probe_device(port, timeout=timeout, use_session=use_session)
+    if responsive and is_micropython:
+        return True, f"Device on {port} responded (MicroPython {details})."
+    elif responsive:
+        return False, f"Device on {port} responded, but does not look like MicroPython: {details}"
+    else:
         suggestion = (
             "Ensure the device is properly connected (try holding BOOT while plugging in, then release BOOT after a few seconds) "
             "and flashed with MicroPython. You can use the 'esp32 flash <firmware_file_or_url>' command to flash it."
         )
-        return False, f"No response or error on {port}. Details: {err_msg}\n{suggestion}"
+        return False, f"No response or error on {port}. Details: {details}\n{suggestion}"
+
+def test_device_cached(port, use_cache=True):
+    """
+    test_device, reusing a successful result from the last TEST_DEVICE_CACHE_TTL seconds. Failures aren't cached,
+    so a board that was just fixed (reset, taken out of bootloader mode) is tested again straight away.
+    Results are keyed by the port's USB identity (VID, PID, serial number), so a different board plugged into
+    the same port is tested afresh.
+    use_cache: False to always test the device (e.g. when diagnosing a connection).
+    """
+    port_info = next((p for p in list_ports() if p.device == port), None)
+    cache_key = "|".join(str(getattr(port_info, field, None)) for field in ("device", "vid", "pid", "serial_number")) if port_info else port
+    try:
+        with open(TEST_DEVICE_CACHE_FILE, "rb") as f:
+            cached_results = dict(json.load(f))
+    except (OSError, ValueError, TypeError):
+        cached_results = {}
+    if use_cache:
+        try:
+            tested_at, ok, msg = cached_results[cache_key]
+            if 0 <= time.time() - tested_at < TEST_DEVICE_CACHE_TTL:
+                return ok, msg
+        except (KeyError, ValueError, TypeError):
+            pass
+    ok, msg = test_device(port)
+    # Keep other ports' results, dropping the ones that have expired
+    now = time.time()
+    try:
+        cached_results = {key: entry for key, entry in cached_results.items() if 0 <= now - entry[0] < TEST_DEVICE_CACHE_TTL}
+    except (KeyError, IndexError, TypeError): # Not a cache this function wrote
+        cached_results = {}
+    if ok:
+        cached_results[cache_key] = [now, ok, msg]
+    else:
+        cached_results.pop(cache_key, None)
+    write_cache_file(TEST_DEVICE_CACHE_FILE, cached_results)
+    return ok, msg
 
 def test_micropython_presence(port, timeout=MP_TIMEOUT_EXEC):
     global DEVICE_PORT 
@@ -178,31 +596,60 @@ def test_micropython_presence(port, timeout=MP_TIMEOUT_EXEC):
     if not port_to_test:
         return False, "Device port not set for MicroPython presence test."
 
-    code_to_run = "import sys; print(sys.implementation.name)"
     print(f"Verifying MicroPython presence on {port_to_test}...")
-    result = run_mpremote_command(["exec", code_to_run], connect_port=port_to_test, suppress_output=True, timeout=timeout)
-    time.sleep(FS_OPERATION_DELAY / 2) 
-    
-    if result and result.returncode == 0 and result.stdout:
-        output_name = result.stdout.strip().lower()
-        if "micropython" in output_name:
-            return True, f"MicroPython confirmed on {port_to_test} (sys.implementation.name: '{output_name}')."
-        else:
-            return False, f"Connected to {port_to_test}, but unexpected response for MicroPython check: {result.stdout.strip()}"
-    elif result and result.returncode == -99: 
-         return False, f"Failed to query MicroPython presence: {result.stderr}"
+    responsive, is_micropython, details = probe_device(port_to_test, timeout=timeout)
+    if is_micropython:
+        return True, f"MicroPython confirmed on {port_to_test}."
+    elif responsive:
+        return False, f"Connected to {port_to_test}, but unexpected response for MicroPython check: {details}"
     else:
-        err_msg = result.stderr.strip() if result and result.stderr else "No response or mpremote error during verification."
-        return False, f"Failed to query MicroPython presence on {port_to_test}. Details: {err_msg}"
+        return False, f"Failed to query MicroPython presence on {port_to_test}. Details: {details}"
 
-def cmd_device(port_arg, force=False):
+def wait_for_micropython(port, budget=REBOOT_WAIT_BUDGET):
+    """
+    Polls a freshly flashed device until MicroPython answers, for up to budget seconds, instead of sleeping
+    for a fixed reboot time first. Returns (verified, message) like test_micropython_presence().
+    Probes spawn mpremote rather than opening the shared session, so a port that hasn't reappeared yet
+    isn't written off for the session, and several devices can be polled from worker threads.
+    """
+    print(f"Verifying MicroPython presence on {port}...")
+    deadline = time.monotonic() + budget
+    while True:
+        time.sleep(REBOOT_POLL_INTERVAL)
+        remaining = deadline - time.monotonic()
+        responsive, is_micropython, details = probe_device(port, timeout=max(1, min(MP_TIMEOUT_PROBE, remaining)), use_session=False)
+        if is_micropython:
+            return True, f"MicroPython confirmed on {port}."
+        if time.monotonic() >= deadline:
+            break
+    if responsive:
+        return False, f"Connected to {port}, but unexpected response for MicroPython check: {details}"
+    return False, f"Failed to query MicroPython presence on {port}. Details: {details}"
+
+def probe_candidate_ports():
+    """
+    Tests every port that looks like an ESP32 (see partition_ports) concurrently, so one unresponsive port
+    doesn't hold up the others, and prints the results in port order.
+    """
+    likely, _ = partition_ports(list_ports())
+    if not likely:
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    print(f"\nProbing {len(likely)} likely ESP32 port(s)...")
+    # A few workers at most: opening many USB serial devices at once contends on some platforms (notably Windows)
+    with ThreadPoolExecutor(max_workers=min(PROBE_MAX_WORKERS, len(likely))) as executor:
+        results = executor.map(lambda p: test_device(p.device, timeout=MP_TIMEOUT_PROBE, use_session=False), likely)
+        for p, (ok, msg) in sorted(zip(likely, results), key=lambda item: item[0].device):
+            print(f"  {msg.splitlines()[0] if ok or msg.startswith('Device on') else f'No MicroPython response on {p.device}.'}")
+
+def cmd_device(port_arg, force=False, use_cache=True):
     global DEVICE_PORT
-    available = [p.device for p in list_ports()]
-    if port_arg not in available:
-        print(f"Error: Port {port_arg} not found among available ports: {', '.join(available) if available else 'None'}", file=sys.stderr)
+    devices = {p.device: p for p in list_ports()}
+    if port_arg not in devices:
+        print(f"Error: Port {port_arg} not found among available ports: {', '.join(sorted(devices)) if devices else 'None'}", file=sys.stderr)
         sys.exit(1)
     
-    ok, result_msg = test_device(port_arg) 
+    ok, result_msg = test_device_cached(port_arg, use_cache)
     print(result_msg)
     
     if not ok and not force:
@@ -211,67 +658,219 @@ def cmd_device(port_arg, force=False):
         
     cfg = load_config()
     cfg["port"] = port_arg
+    port_info = devices[port_arg]
+    # Remember which board this is, so the selection follows it if it's replugged under another port name
+    if port_info.serial_number: cfg["device_id"] = [port_info.vid, port_info.pid, port_info.serial_number]
+    else: cfg.pop("device_id", None)
     save_config(cfg)
     DEVICE_PORT = port_arg 
+    _list_ports_cached.cache_clear()
     if ok:
         print(f"Selected COM port set to {port_arg}.")
     else:
         print(f"Selected COM port set to {port_arg} (forced).")
 
+def resolve_configured_port(cfg):
+    """
+    Returns the configured port. If the board selected with 'esp32 device' (cfg["device_id"]: VID, PID, USB serial number)
+    is no longer on that port but is attached under another name (replugged, renumbered), returns and saves that port.
+    """
+    port = cfg.get("port")
+    device_id = cfg.get("device_id")
+    if not device_id:
+        return port
+    ports = list_ports()
+    if any(p.device == port for p in ports):
+        return port
+    for p in ports:
+        if [p.vid, p.pid, p.serial_number] == device_id:
+            print(f"Selected device is now on {p.device} (was {port}); updating the selected COM port.", file=sys.stderr)
+            cfg["port"] = p.device
+            save_config(cfg)
+            return p.device
+    return port
+
 def ensure_remote_dir(remote_dir_to_create):
+    return not ensure_remote_dirs([remote_dir_to_create])
+
+def ensure_remote_dirs(remote_dirs_to_create):
+    """
+    Creates remote directories, including missing parents, with a single `mpremote exec`.
+    remote_dirs_to_create: Path strings relative to root (e.g., ["lib", "lib/sub", "app"])
+    Returns the list of requested directories that couldn't be created (empty on success).
+    """
     global DEVICE_PORT
     if not DEVICE_PORT:
         print("Error: Device port not set. Cannot ensure remote directory.", file=sys.stderr)
-        return False
-
-    normalized_path = remote_dir_to_create.strip("/")
-    if not normalized_path: 
-        return True
+        return list(remote_dirs_to_create)
 
-    parts = Path(normalized_path).parts
-    current_remote_path_str = ""
-
-    for part in parts:
-        if not current_remote_path_str:
-            current_remote_path_str = part
+    requested_paths = [remote_dir.strip("/") for remote_dir in remote_dirs_to_create]
+    path_components = [] # e.g. ['a', 'a/b', 'a/b/c'], parents first
+    for normalized_path in requested_paths:
+        if not normalized_path or _REMOTE_STAT_CACHE.get(normalized_path) == "dir":
+            continue
+        parts = [part for part in normalized_path.split("/") if part]
+        for i in range(len(parts)):
+            component = "/".join(parts[:i + 1])
+            if component not in path_components and _REMOTE_STAT_CACHE.get(component) != "dir":
+                path_components.append(component)
+    if not path_components:
+        return []
+
+    # Create every missing component in one exec instead of one mpremote run per component.
+    # The device prints '+path' for each directory it creates and '!path' for a component that is a file
+    # (whose would-be subdirectories are then skipped).
+    code = (
+        "import uos\n"
+        "bad = []\n"
+        f"for p in {['/' + component for component in path_components]!r}:\n"
+        "    if any(p.startswith(b + '/') for b in bad): continue\n"
+        "    try:\n"
+        "        uos.mkdir(p)\n"
+        "        print('+' + p)\n"
+        "    except OSError as e:\n"
+        "        if e.args[0] != 17: raise\n"
+        "        if not uos.stat(p)[0] & 0x4000:\n"
+        "            print('!' + p)\n"
+        "            bad.append(p)\n"
+    )
+    result = run_with_retry(lambda: run_mpremote_exec(code, timeout=MP_TIMEOUT_MKDIR))
+    time.sleep(FS_OPERATION_DELAY)
+
+    if not result or result.returncode != 0:
+        err_msg = result.stderr.strip() if result and result.stderr else f"Unknown error creating ':{path_components[-1]}'"
+        if result and not err_msg and result.stdout: 
+             err_msg = result.stdout.strip()
+        failed_paths = [normalized_path for normalized_path in requested_paths if normalized_path in path_components]
+        for normalized_path in failed_paths:
+            print(f"Error creating remote directory ':{normalized_path}': {err_msg}", file=sys.stderr)
+            _invalidate_remote_path(normalized_path)
+        return failed_paths
+
+    created_components = set()
+    file_components = []
+    for line in result.stdout.splitlines():
+        line = line.strip()
+        if line.startswith("+"):
+            created_components.add(line[1:].strip("/"))
+            print(f"    Created remote directory component ':{line[1:].strip('/')}'.")
+        elif line.startswith("!"):
+            print(f"Error: Remote path ':{line[1:].strip('/')}' exists and is a file, cannot create directory.", file=sys.stderr)
+            file_components.append(line[1:].strip("/"))
+            _invalidate_remote_path(line[1:])
+
+    def under_file(path): return any(path == bad or path.startswith(f"{bad}/") for bad in file_components)
+    for component in path_components:
+        if under_file(component):
+            continue
+        if component in created_components:
+            _cache_remote_path(component, "dir")
+            _STAT_CACHE_PRIMED_DIRS.add(component) # Freshly created, so known to be empty
         else:
-            current_remote_path_str = f"{current_remote_path_str}/{part}"
-        
-        path_type_check = get_remote_path_stat(current_remote_path_str)
-        time.sleep(FS_OPERATION_DELAY / 4)
+            _REMOTE_STAT_CACHE[component] = "dir"
+    return [normalized_path for normalized_path in requested_paths if under_file(normalized_path)]
 
-        if path_type_check == "dir":
-            continue 
-        if path_type_check == "file":
-            print(f"Error: Remote path ':{current_remote_path_str}' exists and is a file, cannot create directory.", file=sys.stderr)
-            return False
-        
-        print(f"    Creating remote directory component ':{current_remote_path_str}'...")
-        result = run_mpremote_command(["fs", "mkdir", f":{current_remote_path_str}"], suppress_output=True, timeout=MP_TIMEOUT_MKDIR)
-        time.sleep(FS_OPERATION_DELAY) 
+def upload_files_batched(upload_jobs):
+    """
+    Uploads files using chained mpremote invocations of up to MP_BATCH_SIZE copies each.
+    mpremote itself skips files whose remote copy already has the same SHA-256 ("Up to date: ...").
+    upload_jobs: list of (display_name, cp_args) tuples, where cp_args is a ["fs", "cp", src, dest] list.
+    Returns (files_uploaded_count, files_unchanged_count).
+    """
+    files_uploaded_count = 0
+    files_unchanged_count = 0
+    retry_attempt = 0 # Transport failures in a row without any copy finishing
+    pending_jobs = list(upload_jobs)
+    while pending_jobs:
+        batch = pending_jobs[:MP_BATCH_SIZE]
+        pending_jobs = pending_jobs[MP_BATCH_SIZE:]
+
+        for display_name, cp_args in batch:
+            print(f"  Uploading '{display_name}' to '{cp_args[-1]}'...")
+
+        result = run_mpremote_batch([cp_args for _, cp_args in batch], timeout=MP_TIMEOUT_CP_FILE * len(batch))
+        time.sleep(FS_OPERATION_DELAY)
 
         if result and result.returncode == 0:
-            # print(f"    Created remote directory component ':{current_remote_path_str}'") # Redundant with above print
-            pass
-        elif result and result.stderr and ("EEXIST" in result.stderr or "File exists" in result.stderr):
-            path_type_check_after_mkdir = get_remote_path_stat(current_remote_path_str)
-            time.sleep(FS_OPERATION_DELAY / 4) 
-            if path_type_check_after_mkdir == "dir":
-                continue 
-            else:
-                err_msg = f"Path ':{current_remote_path_str}' exists but is not a directory (it is {path_type_check_after_mkdir or 'of an unknown type'})."
-                print(f"Error creating remote directory component ':{current_remote_path_str}': {err_msg}", file=sys.stderr)
-                return False
-        else:
-            err_msg = result.stderr.strip() if result and result.stderr else f"Unknown error creating ':{current_remote_path_str}'"
-            if result and not err_msg and result.stdout: 
-                 err_msg = result.stdout.strip()
-            print(f"Error creating remote directory component ':{current_remote_path_str}': {err_msg}", file=sys.stderr)
-            return False
-            
-    return True
+            retry_attempt = 0
+            unchanged_count = sum(1 for line in (result.stdout or "").splitlines() if line.startswith("Up to date:"))
+            files_uploaded_count += len(batch) - unchanged_count
+            files_unchanged_count += unchanged_count
+            for _, cp_args in batch:
+                _cache_remote_path(cp_args[-1], "file")
+            continue
 
-def cmd_upload(local_src_arg, remote_dest_arg=None):
+        # mpremote echoes "cp <src> <dest>" before each copy and stops at the first failure,
+        # so the number of echoed copies tells which item failed.
+        started_count = sum(1 for line in (result.stdout or "").splitlines() if line.startswith("cp ")) if result else 0
+        finished_count = max(started_count - 1, 0)
+        files_uploaded_count += finished_count
+        for _, cp_args in batch[:finished_count]:
+            _cache_remote_path(cp_args[-1], "file")
+        retry_attempt = 0 if finished_count else retry_attempt
+        if is_transport_failure(result) and retry_attempt < MP_RETRY_ATTEMPTS - 1:
+            # Send only the copies that didn't finish again
+            time.sleep(MP_RETRY_BASE_DELAY * 2 ** retry_attempt)
+            retry_attempt += 1
+            pending_jobs = batch[finished_count:] + pending_jobs
+            continue
+        retry_attempt = 0
+
+        err_msg = result.stderr.strip() if result and result.stderr else "File upload failed"
+        if started_count == 0:
+            for display_name, cp_args in batch:
+                _invalidate_remote_path(cp_args[-1])
+                print(f"    Error uploading file '{display_name}': {err_msg}", file=sys.stderr)
+            continue
+
+        _invalidate_remote_path(batch[started_count - 1][1][-1])
+        print(f"    Error uploading file '{batch[started_count - 1][0]}': {err_msg}", file=sys.stderr)
+        # Items after the failed one were never attempted; queue them for the next invocation.
+        pending_jobs = batch[started_count:] + pending_jobs
+
+    return files_uploaded_count, files_unchanged_count
+
+def _skip_upload_name(name):
+    return name in UPLOAD_SKIP_NAMES or name.startswith(".") or name.endswith(UPLOAD_SKIP_SUFFIXES)
+
+def queue_upload_jobs(abs_local_path, remote_base_for_items_str, job_queue, skip_dev_files=False):
+    """
+    Walks a local directory and queues the work needed to upload its contents under remote_base_for_items_str.
+    Queues ("dir", remote_dir) for each subdirectory, ("file", remote_dir, display_name, cp_args) for each file,
+    and finally None. Directories are always queued before anything inside them.
+    skip_dev_files: True to leave out entries matched by _skip_upload_name, queueing ("skip", display_name) for each.
+    """
+    # os.walk yields roots prefixed with the top directory string, so plain string slicing gives
+    # the relative parts without building Path objects for every file.
+    abs_local_path_str = str(abs_local_path)
+    try:
+        for root, dirs, files in os.walk(abs_local_path_str):
+            relative_dir_str = root[len(abs_local_path_str):].lstrip(os.sep)
+            relative_dir_posix = relative_dir_str.replace(os.sep, "/")
+            root_posix = root.replace(os.sep, "/").rstrip("/")
+            current_remote_target_dir_str = remote_base_for_items_str
+            if relative_dir_posix:
+                current_remote_target_dir_str = f"{remote_base_for_items_str}/{relative_dir_posix}" if remote_base_for_items_str else relative_dir_posix
+            remote_prefix = f"{current_remote_target_dir_str}/" if current_remote_target_dir_str else ""
+            display_prefix = f"{relative_dir_str}{os.sep}" if relative_dir_str else ""
+
+            if skip_dev_files:
+                for skipped_name in sorted(name for name in dirs + files if _skip_upload_name(name)):
+                    job_queue.put(("skip", f"{display_prefix}{skipped_name}"))
+                # Prune in place so os.walk doesn't descend into skipped directories
+                dirs[:] = [name for name in dirs if not _skip_upload_name(name)]
+                files = [name for name in files if not _skip_upload_name(name)]
+            dirs.sort()
+            for dir_name in dirs:
+                job_queue.put(("dir", f"{remote_prefix}{dir_name}"))
+
+            for file_name in sorted(files):
+                cp_args_file = ["fs", "cp", f"{root_posix}/{file_name}", f":{remote_prefix}{file_name}"]
+                job_queue.put(("file", current_remote_target_dir_str, f"{display_prefix}{file_name}", cp_args_file))
+    finally:
+        job_queue.put(None)
+
+def cmd_upload(local_src_arg, remote_dest_arg=None, skip_dev_files=False):
     global DEVICE_PORT
     
     had_trailing_slash_local = local_src_arg.endswith(("/", os.sep))
@@ -286,12 +885,14 @@ def cmd_upload(local_src_arg, remote_dest_arg=None):
 
     abs_local_path = Path(os.path.abspath(local_src_for_path_obj))
 
-    if not abs_local_path.exists():
+    try:
+        local_stat = abs_local_path.stat() # One stat instead of exists() + is_file() + is_dir()
+    except OSError:
         print(f"Error: Local path '{original_local_src_display}' (resolved to '{abs_local_path}') does not exist.", file=sys.stderr)
         sys.exit(1)
     
-    is_local_file = abs_local_path.is_file()
-    is_local_dir = abs_local_path.is_dir()
+    is_local_file = stat.S_ISREG(local_stat.st_mode)
+    is_local_dir = stat.S_ISDIR(local_stat.st_mode)
 
     if not is_local_file and not is_local_dir:
         print(f"Error: Local path '{original_local_src_display}' is neither a file nor a directory.", file=sys.stderr)
@@ -315,12 +916,14 @@ def cmd_upload(local_src_arg, remote_dest_arg=None):
         
         print(f"Uploading file '{abs_local_path}' to '{mpremote_target_path_on_device}' on device...")
         cp_args = ["fs", "cp", str(abs_local_path).replace(os.sep, '/'), mpremote_target_path_on_device]
-        result = run_mpremote_command(cp_args, suppress_output=True, timeout=MP_TIMEOUT_CP_FILE)
+        result = run_with_retry(lambda: run_mpremote_command(cp_args, suppress_output=True, timeout=MP_TIMEOUT_CP_FILE))
         time.sleep(FS_OPERATION_DELAY) 
         
         if result and result.returncode == 0:
+            _cache_remote_path(mpremote_target_path_on_device, "file")
             print("File upload complete.")
         else:
+            _invalidate_remote_path(mpremote_target_path_on_device)
             err_msg = result.stderr.strip() if result and result.stderr else "File upload failed"
             if result and not err_msg and result.stdout: err_msg = result.stdout.strip()
             print(f"Error uploading file '{original_local_src_display}': {err_msg}", file=sys.stderr)
@@ -347,42 +950,131 @@ def cmd_upload(local_src_arg, remote_dest_arg=None):
             print(f"Ensuring remote target directory ':{remote_base_for_items_str}' exists...")
             if not ensure_remote_dir(remote_base_for_items_str): sys.exit(1)
 
-        files_uploaded_count = 0
-        for root, dirs, files in os.walk(str(abs_local_path)):
-            root_path = Path(root)
-            relative_dir_path_from_src = root_path.relative_to(abs_local_path)
-            current_remote_target_dir_str = remote_base_for_items_str
-            if str(relative_dir_path_from_src) != ".":
-                current_remote_target_dir_str = f"{remote_base_for_items_str}/{relative_dir_path_from_src.as_posix()}" if remote_base_for_items_str else relative_dir_path_from_src.as_posix()
+        # A producer thread walks the local tree while this thread feeds mpremote,
+        # so local path handling overlaps with the (much slower) serial transfers.
+        import queue, threading
+        job_queue = queue.Queue()
+        producer = threading.Thread(target=queue_upload_jobs, args=(abs_local_path, remote_base_for_items_str, job_queue, skip_dev_files), daemon=True)
+        producer.start()
 
-            for dir_name in sorted(dirs):
-                remote_subdir_to_ensure = Path(current_remote_target_dir_str) / dir_name
-                # No print here, ensure_remote_dir will print if it creates something
-                if not ensure_remote_dir(remote_subdir_to_ensure.as_posix()):
-                    print(f"    Failed to create remote subdirectory ':{remote_subdir_to_ensure.as_posix()}'. Skipping its contents.", file=sys.stderr)
-                    dirs.remove(dir_name) # Don't try to recurse into it
-
-            for file_name in sorted(files):
-                local_file_full_path = root_path / file_name
-                remote_file_target_on_device_str = f":{current_remote_target_dir_str}/{file_name}" if current_remote_target_dir_str else f":{file_name}"
-
-                print(f"  Uploading '{local_file_full_path.relative_to(abs_local_path)}' to '{remote_file_target_on_device_str}'...")
-                cp_args_file = ["fs", "cp", str(local_file_full_path).replace(os.sep, '/'), remote_file_target_on_device_str]
-                result_file = run_mpremote_command(cp_args_file, suppress_output=True, timeout=MP_TIMEOUT_CP_FILE)
-                time.sleep(FS_OPERATION_DELAY) 
-                
-                if result_file and result_file.returncode == 0:
-                    files_uploaded_count += 1
-                else:
-                    err_msg = result_file.stderr.strip() if result_file and result_file.stderr else "File upload failed"
-                    if result_file and not err_msg and result_file.stdout: err_msg = result_file.stdout.strip()
-                    print(f"    Error uploading file '{local_file_full_path.relative_to(abs_local_path)}': {err_msg}", file=sys.stderr)
-
-        print(f"Directory upload processed. {files_uploaded_count} files uploaded.")
+        files_uploaded_count = 0
+        files_unchanged_count = 0
+        pending_jobs = []
+        failed_remote_dirs = []
+        pending_dirs = [] # Subdirectories are created together, just before the first file that needs one of them
+
+        def create_pending_dirs():
+            # No print here, ensure_remote_dirs will print if it creates something
+            for failed in ensure_remote_dirs(pending_dirs):
+                print(f"    Failed to create remote subdirectory ':{failed}'. Skipping its contents.", file=sys.stderr)
+                failed_remote_dirs.append(failed)
+            pending_dirs.clear()
+
+        while (job := job_queue.get()) is not None:
+            job_kind, remote_dir_str = job[0], job[1]
+            if job_kind == "skip":
+                print(f"  Skipping '{job[1]}'.")
+                continue
+            if job_kind == "dir":
+                pending_dirs.append(remote_dir_str)
+                continue
+            if remote_dir_str in pending_dirs:
+                create_pending_dirs()
+            if any(remote_dir_str == failed or remote_dir_str.startswith(f"{failed}/") for failed in failed_remote_dirs):
+                continue # Parent directory couldn't be created; skip its contents
+            pending_jobs.append(job[2:])
+            if len(pending_jobs) == MP_BATCH_SIZE:
+                uploaded_count, unchanged_count = upload_files_batched(pending_jobs)
+                files_uploaded_count += uploaded_count
+                files_unchanged_count += unchanged_count
+                pending_jobs = []
+        create_pending_dirs() # Empty directories
+        uploaded_count, unchanged_count = upload_files_batched(pending_jobs)
+        files_uploaded_count += uploaded_count
+        files_unchanged_count += unchanged_count
+        producer.join()
+
+        print(f"Directory upload processed. {files_uploaded_count} files uploaded, {files_unchanged_count} unchanged files skipped.")
     else: 
         print(f"Error: Unhandled local source type for '{original_local_src_display}'.", file=sys.stderr)
         sys.exit(1)
 
+def parse_port_list(ports_arg):
+    """Splits a comma-separated --ports value into port names."""
+    return [port.strip() for port in ports_arg.split(",") if port.strip()]
+
+def upload_to_ports(ports, local_src_arg, remote_dest_arg=None, skip_dev_files=False):
+    """
+    Uploads the same source to several devices at once. Each port gets its own `esp32 upload` subprocess,
+    since the devices' serial links are independent. Prints each device's output as it finishes.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    def upload_to_port(port):
+        upload_cmd = [sys.executable, "-m", "esp32_micropython", "--port", port, "upload", local_src_arg]
+        if remote_dest_arg: upload_cmd.append(remote_dest_arg)
+        if skip_dev_files: upload_cmd.append("--skip-dev-files")
+        return _decode(subprocess.run(upload_cmd, capture_output=True, check=False, **_CAPTURED_SPAWN_KW))
+
+    print(f"Uploading '{local_src_arg}' to {len(ports)} devices: {', '.join(ports)}...")
+    failed_ports = []
+    with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        futures = {executor.submit(upload_to_port, port): port for port in ports}
+        for future in as_completed(futures):
+            port, result = futures[future], future.result()
+            print(f"\n--- {port} ---")
+            print(result.stdout, end="")
+            if result.stderr: print(result.stderr, end="", file=sys.stderr)
+            if result.returncode != 0: failed_ports.append(port)
+
+    if failed_ports:
+        print(f"\nUpload failed on: {', '.join(sorted(failed_ports))}", file=sys.stderr)
+        sys.exit(1)
+    print(f"\nUpload completed on all {len(ports)} devices.")
+
+def download_files_batched(download_jobs):
+    """
+    Downloads files using chained mpremote invocations of up to MP_BATCH_SIZE copies each.
+    download_jobs: list of ["fs", "cp", ":remote_src", local_dest] lists.
+    Returns the number of files downloaded.
+    """
+    files_downloaded_count = 0
+    retry_attempt = 0 # Transport failures in a row without any copy finishing
+    pending_jobs = list(download_jobs)
+    while pending_jobs:
+        batch = pending_jobs[:MP_BATCH_SIZE]
+        pending_jobs = pending_jobs[MP_BATCH_SIZE:]
+        for cp_args in batch:
+            print(f"  Downloading remote file '{cp_args[2]}' to '{cp_args[3]}'...")
+
+        result = run_mpremote_batch(batch, timeout=MP_TIMEOUT_CP_FILE * len(batch))
+        time.sleep(FS_OPERATION_DELAY)
+        if result and result.returncode == 0:
+            retry_attempt = 0
+            files_downloaded_count += len(batch)
+            continue
+
+        # As for uploads: the "cp" lines mpremote echoed tell which copy failed; later ones never ran
+        started_count = sum(1 for line in (result.stdout or "").splitlines() if line.startswith("cp ")) if result else 0
+        finished_count = max(started_count - 1, 0)
+        files_downloaded_count += finished_count
+        retry_attempt = 0 if finished_count else retry_attempt
+        if is_transport_failure(result) and retry_attempt < MP_RETRY_ATTEMPTS - 1:
+            time.sleep(MP_RETRY_BASE_DELAY * 2 ** retry_attempt)
+            retry_attempt += 1
+            pending_jobs = batch[finished_count:] + pending_jobs
+            continue
+        retry_attempt = 0
+
+        err_msg = result.stderr.strip() if result and result.stderr else "File download failed"
+        if started_count == 0:
+            for cp_args in batch:
+                print(f"    Error downloading file '{cp_args[2]}': {err_msg}", file=sys.stderr)
+            continue
+        print(f"    Error downloading file '{batch[started_count - 1][2]}': {err_msg}", file=sys.stderr)
+        pending_jobs = batch[started_count:] + pending_jobs
+    return files_downloaded_count
+
 def cmd_download(remote_src_arg, local_dest_arg=None):
     global DEVICE_PORT
     had_trailing_slash_remote = remote_src_arg.endswith("/")
@@ -427,7 +1119,7 @@ def cmd_download(remote_src_arg, local_dest_arg=None):
 
         print(f"Downloading remote file '{mpremote_remote_source_str}' to local path '{final_mpremote_local_dest_str}'...")
         cp_args = ["fs", "cp", mpremote_remote_source_str, final_mpremote_local_dest_str]
-        result = run_mpremote_command(cp_args, suppress_output=True, timeout=MP_TIMEOUT_CP_FILE)
+        result = run_with_retry(lambda: run_mpremote_command(cp_args, suppress_output=True, timeout=MP_TIMEOUT_CP_FILE))
         time.sleep(FS_OPERATION_DELAY) 
         
         if result and result.returncode == 0:
@@ -498,6 +1190,7 @@ def cmd_download(remote_src_arg, local_dest_arg=None):
             elif item_type == "file":
                 processed_items.append((False, remote_item_abs_str, local_target_path))
 
+        download_jobs = []
         for is_dir, remote_abs_path_str, local_target_path_obj in processed_items:
             if is_dir:
                 print(f"  Ensuring local directory '{local_target_path_obj}' exists...")
@@ -506,18 +1199,8 @@ def cmd_download(remote_src_arg, local_dest_arg=None):
             else: 
                 local_target_path_obj.parent.mkdir(parents=True, exist_ok=True)
                 mpremote_remote_source_for_file = ":" + remote_abs_path_str.lstrip('/')
-                
-                print(f"  Downloading remote file '{mpremote_remote_source_for_file}' to '{local_target_path_obj}'...")
-                cp_args_file = ["fs", "cp", mpremote_remote_source_for_file, str(local_target_path_obj).replace(os.sep, '/')]
-                result_file = run_mpremote_command(cp_args_file, suppress_output=True, timeout=MP_TIMEOUT_CP_FILE)
-                time.sleep(FS_OPERATION_DELAY) 
-                
-                if result_file and result_file.returncode == 0:
-                    files_downloaded_count += 1
-                else:
-                    err_msg = result_file.stderr.strip() if result_file and result_file.stderr else "File download failed"
-                    if result_file and not err_msg and result_file.stdout: err_msg = result_file.stdout.strip()
-                    print(f"    Error downloading file '{mpremote_remote_source_for_file}': {err_msg}", file=sys.stderr)
+                download_jobs.append(["fs", "cp", mpremote_remote_source_for_file, str(local_target_path_obj).replace(os.sep, '/')])
+        files_downloaded_count = download_files_batched(download_jobs)
 
         print(f"Directory download processed. {dirs_created_count} local directories created/ensured, {files_downloaded_count} files downloaded.")
     else: 
@@ -528,29 +1211,59 @@ def cmd_download(remote_src_arg, local_dest_arg=None):
 def run_script(script="main.py"):
     global DEVICE_PORT
     script_on_device_norm = script.strip('/') 
-    
-    print(f"Checking for '{script_on_device_norm}' on device...")
-    path_type = get_remote_path_stat(script_on_device_norm)
-    time.sleep(FS_OPERATION_DELAY / 2) 
-
-    if path_type is None:
-        print(f"Error: Script ':{script_on_device_norm}' not found on device.", file=sys.stderr)
-        sys.exit(1)
-    if path_type == 'dir':
-        print(f"Error: Path ':{script_on_device_norm}' on device is a directory, not a runnable script.", file=sys.stderr)
-        sys.exit(1)
-    if path_type != 'file':
-        print(f"Error: Path ':{script_on_device_norm}' on device is not a file (type: {path_type}).", file=sys.stderr)
-        sys.exit(1)
-
     abs_script_path_on_device = f"/{script_on_device_norm}" 
     escaped_script_path_for_exec = abs_script_path_on_device.replace("'", "\\'")
-    python_code = f"exec(open('{escaped_script_path_for_exec}').read())"
+    if not open_mpremote_session(DEVICE_PORT):
+        # The mpremote fallback prints the device's traceback itself, so a missing script can't be
+        # recognised from its output; check the path first instead.
+        print(f"Checking for '{script_on_device_norm}' on device...")
+        path_type = get_remote_path_stat(script_on_device_norm)
+        time.sleep(FS_OPERATION_DELAY / 2)
+        if path_type is None:
+            print(f"Error: Script ':{script_on_device_norm}' not found on device.", file=sys.stderr)
+            sys.exit(1)
+        if path_type == 'dir':
+            print(f"Error: Path ':{script_on_device_norm}' on device is a directory, not a runnable script.", file=sys.stderr)
+            sys.exit(1)
+        if path_type != 'file':
+            print(f"Error: Path ':{script_on_device_norm}' on device is not a file (type: {path_type}).", file=sys.stderr)
+            sys.exit(1)
+    # With the session open there is no separate stat round trip: a failing open() is re-raised with a marker
+    # so it can't be mistaken for an OSError raised by the script itself.
+    python_code = f"""\
+try:
+    _f = open('{escaped_script_path_for_exec}')
+except OSError as e:
+    raise OSError('{RUN_SCRIPT_OPEN_MARKER}', e.args[0])
+_s = _f.read()
+_f.close()
+exec(_s)
+"""
     
     print(f"Running '{script_on_device_norm}' on {DEVICE_PORT}...")
-    result = run_mpremote_command(["exec", python_code], suppress_output=False, timeout=None) 
-    if result and result.returncode != 0:
-        pass
+    try:
+        result = run_mpremote_exec(python_code, timeout=None, stream=True)
+    except KeyboardInterrupt:
+        if _MP_SESSION:
+            try:
+                _MP_SESSION.transport.serial.write(b"\x03") # Stop the script, as mpremote does on Ctrl-C
+            except Exception:
+                pass
+            close_mpremote_session()
+        raise
+    stderr = result.stderr or ""
+    if RUN_SCRIPT_OPEN_MARKER in stderr:
+        errno_match = re.search(rf"{RUN_SCRIPT_OPEN_MARKER}', (\d+)", stderr)
+        errno_code = int(errno_match.group(1)) if errno_match else None
+        if errno_code == 2:
+            print(f"Error: Script ':{script_on_device_norm}' not found on device.", file=sys.stderr)
+        elif errno_code == 21:
+            print(f"Error: Path ':{script_on_device_norm}' on device is a directory, not a runnable script.", file=sys.stderr)
+        else:
+            print(f"Error: Could not open ':{script_on_device_norm}' on device (errno {errno_code}).", file=sys.stderr)
+        sys.exit(1)
+    if stderr:
+        print(stderr, end="" if stderr.endswith("\n") else "\n", file=sys.stderr)
 
 
 def list_remote_capture(remote_dir_arg=""): 
@@ -584,10 +1297,21 @@ def _walk(p):
             print(item_full_path)
 _walk('{escaped_path_for_walk_start}')
 """
-    result = run_mpremote_command(["exec", code], suppress_output=True, timeout=MP_TIMEOUT_LS_EXEC)
+    result = run_mpremote_exec(code, timeout=MP_TIMEOUT_LS_EXEC)
     
     if result and result.returncode == 0 and result.stdout:
-        return [line.strip() for line in result.stdout.splitlines() if line.strip().startswith('/')]
+        listed_paths = [line.strip() for line in result.stdout.splitlines() if line.strip().startswith('/')]
+        # The walk is complete, so every directory it visited is fully known.
+        walk_start_key = path_for_walk_start.strip('/')
+        _REMOTE_STAT_CACHE[walk_start_key] = "dir"
+        _STAT_CACHE_PRIMED_DIRS.add(walk_start_key)
+        for listed_path in listed_paths:
+            if listed_path.endswith('/'):
+                _REMOTE_STAT_CACHE[listed_path.strip('/')] = "dir"
+                _STAT_CACHE_PRIMED_DIRS.add(listed_path.strip('/'))
+            else:
+                _REMOTE_STAT_CACHE[listed_path.strip('/')] = "file"
+        return listed_paths
     elif result and result.stderr:
         if not ("No such file or directory" in result.stderr or "ENOENT" in result.stderr):
              print(f"Error during remote listing execution for '{path_for_walk_start}': {result.stderr.strip()}", file=sys.stderr)
@@ -733,55 +1457,48 @@ def delete_remote(remote_path_arg):
             print("Operation cancelled.")
             return
         
-        print("Fetching root directory contents for deletion...")
-        # Get direct children of root. list_remote_capture("") gives all descendants.
-        # We need to delete top-level items first. If a dir is deleted, its contents go with it.
-        # Using mpremote fs ls for direct children is fine here.
-        ls_result = run_mpremote_command(["fs", "ls", ":"], suppress_output=True, timeout=MP_TIMEOUT_LS_MPREMOTE)
-        time.sleep(FS_OPERATION_DELAY /2)
-
-        if not ls_result or ls_result.returncode != 0:
-            err = ls_result.stderr.strip() if ls_result and ls_result.stderr else "Failed to list root."
-            print(f"Error listing root directory for deletion: {err}", file=sys.stderr)
+        print("Deleting root directory contents...")
+        # The whole tree is removed by one exec on the device instead of listing root and running
+        # `fs rm -r` per top-level item. The device prints '-name' for each top-level item it removed
+        # and '!name<TAB>error' for one it couldn't.
+        code = (
+            "import uos\n"
+            "def rmtree(p):\n"
+            "    for e in list(uos.ilistdir(p)):\n"
+            "        c = p + '/' + e[0]\n"
+            "        if e[1] & 0x4000: rmtree(c)\n"
+            "        else: uos.remove(c)\n"
+            "    uos.rmdir(p)\n"
+            "for e in list(uos.ilistdir('/')):\n"
+            "    try:\n"
+            "        if e[1] & 0x4000: rmtree('/' + e[0])\n"
+            "        else: uos.remove('/' + e[0])\n"
+            "        print('-' + e[0])\n"
+            "    except OSError as x:\n"
+            "        print('!' + e[0] + '\\t' + str(x))\n"
+        )
+        del_result = run_mpremote_exec(code, timeout=MP_TIMEOUT_RM)
+        time.sleep(FS_OPERATION_DELAY)
+        _REMOTE_STAT_CACHE.clear() # Anything cached below root may be gone now
+        _STAT_CACHE_PRIMED_DIRS.clear()
+
+        if not del_result or del_result.returncode != 0:
+            err_msg = del_result.stderr.strip() if del_result and del_result.stderr else "Deletion failed"
+            print(f"Error deleting root directory contents: {err_msg}", file=sys.stderr)
             sys.exit(1)
-        
-        items_to_delete_from_root_names = []
-        if ls_result.stdout:
-            for line in ls_result.stdout.splitlines():
-                line_content = line.strip()
-                if not line_content or line_content.lower().startswith("ls ") or line_content == ":" or line_content == "stat":
-                    continue
-                parts = line_content.split(maxsplit=1)
-                item_name = parts[1] if len(parts) == 2 and parts[0].isdigit() else line_content
-                if item_name and item_name != '/': 
-                    items_to_delete_from_root_names.append(item_name.rstrip('/'))
-        
-        if not items_to_delete_from_root_names:
-            print("Root directory is already empty or no valid items found by ls.")
+
+        deleted_names, failed_items = [], []
+        for line in del_result.stdout.splitlines():
+            if line.startswith("-"): deleted_names.append(line[1:])
+            elif line.startswith("!"): failed_items.append(line[1:].partition("\t")[::2])
+        if not deleted_names and not failed_items:
+            print("Root directory is already empty.")
             return
 
-        print(f"Top-level items to delete from root: {items_to_delete_from_root_names}")
-        all_successful = True
-        for item_name_to_delete in items_to_delete_from_root_names:
-            # mpremote fs rm -r :item_name
-            item_target_for_mpremote = ":" + item_name_to_delete
-            
-            print(f"Deleting '{item_target_for_mpremote}'...")
-            del_result = run_mpremote_command(
-                ["fs", "rm", "-r", item_target_for_mpremote], 
-                suppress_output=True, 
-                timeout=MP_TIMEOUT_RM 
-            )
-            time.sleep(FS_OPERATION_DELAY) 
-            if del_result and del_result.returncode == 0:
-                pass 
-            else:
-                all_successful = False
-                err_msg = del_result.stderr.strip() if del_result and del_result.stderr else "Deletion failed"
-                if del_result and not err_msg and del_result.stdout: err_msg = del_result.stdout.strip()
-                print(f"  Error deleting '{item_target_for_mpremote}': {err_msg}", file=sys.stderr)
-        
-        if all_successful: print("Deletion of root contents complete.")
+        if deleted_names: print(f"Deleted top-level items: {deleted_names}")
+        for failed_name, err_msg in failed_items:
+            print(f"  Error deleting ':{failed_name}': {err_msg}", file=sys.stderr)
+        if not failed_items: print("Deletion of root contents complete.")
         else:
             print("Deletion of root contents attempted, but some errors occurred.", file=sys.stderr)
             sys.exit(1) 
@@ -802,8 +1519,10 @@ def delete_remote(remote_path_arg):
         time.sleep(FS_OPERATION_DELAY)
         
         if del_result and del_result.returncode == 0:
+            _cache_remote_path(mpremote_target_path, None)
             print(f"Deleted '{mpremote_target_path}'.")
         else:
+            _invalidate_remote_path(mpremote_target_path)
             err_msg = del_result.stderr.strip() if del_result and del_result.stderr else "Deletion failed"
             if del_result and not err_msg and del_result.stdout: err_msg = del_result.stdout.strip()
             print(f"Error deleting '{mpremote_target_path}': {err_msg}", file=sys.stderr)
@@ -826,7 +1545,8 @@ def cmd_diagnostics():
         print(f"\n--- {step['desc']} ---")
         result = None
         if step["type"] == "exec":
-            result = run_mpremote_command(["exec", step["code"]], suppress_output=False, timeout=step["timeout"])
+            result = run_mpremote_exec(step["code"], timeout=step["timeout"])
+            if result.returncode == 0: print(result.stdout, end="")
         elif step["type"] == "mpremote_cmd":
             result = run_mpremote_command(step["args"], suppress_output=False, timeout=step["timeout"])
         
@@ -843,7 +1563,244 @@ def cmd_diagnostics():
     else: print("\nDiagnostics completed with some errors.")
 
 
-def cmd_flash(firmware_source, baud_rate_str="230400"):
+def firmware_temp_dir():
+    """
+    Returns a RAM-backed directory (Linux /dev/shm) for downloaded firmware, or None for the default temp dir.
+    esptool needs a seekable file path, so the image can't be piped in; tmpfs keeps it off the disk instead.
+    """
+    shm_dir = "/dev/shm"
+    if os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK):
+        return shm_dir
+    return None
+
+def firmware_cache_paths(firmware_url):
+    """Returns the (image, metadata) cache file paths for a firmware URL. The image keeps the URL's file name."""
+    import hashlib, urllib.parse
+    url_key = hashlib.sha256(firmware_url.encode()).hexdigest()[:16]
+    url_file_name = re.sub(r"[^\w.-]", "_", os.path.basename(urllib.parse.urlparse(firmware_url).path)) or "firmware.bin"
+    return os.path.join(FIRMWARE_CACHE_DIR, f"{url_key}-{url_file_name}"), os.path.join(FIRMWARE_CACHE_DIR, f"{url_key}.json")
+
+def download_firmware(firmware_url, show_progress=True):
+    """
+    Downloads a firmware image and returns (path, is_temporary). Exits on download errors.
+    Images are kept in FIRMWARE_CACHE_DIR along with their ETag/Last-Modified and SHA-256, and downloading the
+    same URL again is a conditional GET: a 304 Not Modified reuses the cached copy (if it still matches its
+    hash) without transferring the body. A transfer shorter than its Content-Length is rejected.
+    If the cache can't be written, the image goes to a temporary file (is_temporary) for the caller to remove.
+    show_progress: Print the size and a progress bar (off when running alongside esptool's output).
+    """
+    import urllib.request, urllib.error, tempfile, hashlib # Only needed for downloads, so kept off the startup path
+    cache_file, cache_meta_file = firmware_cache_paths(firmware_url)
+    try:
+        os.makedirs(FIRMWARE_CACHE_DIR, exist_ok=True)
+        download_dir = FIRMWARE_CACHE_DIR
+    except OSError:
+        cache_file, download_dir = None, firmware_temp_dir()
+
+    request = urllib.request.Request(firmware_url)
+    cached_meta = {}
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            with open(cache_meta_file, "rb") as f: cached_meta = json.load(f)
+        except (OSError, ValueError):
+            cached_meta = {}
+        if cached_meta.get("etag"): request.add_header("If-None-Match", cached_meta["etag"])
+        if cached_meta.get("last_modified"): request.add_header("If-Modified-Since", cached_meta["last_modified"])
+
+    tmp_file_name = None
+    try:
+        with urllib.request.urlopen(request) as response, \
+             tempfile.NamedTemporaryFile(delete=False, suffix=".bin", mode='wb', dir=download_dir) as tmp_file:
+            tmp_file_name = tmp_file.name
+            total_size = response.getheader('Content-Length')
+            if total_size:
+                total_size = int(total_size)
+                if show_progress: print("File size:", total_size // 1024, "KB")
+            elif show_progress:
+                print("File size: Unknown (Content-Length header not found)")
+            downloaded_size = 0; chunk_size = 64 * 1024; progress_ticks = 0 # Large reads, but still several per 5% progress step
+            file_hash = hashlib.sha256() # Fed chunk by chunk, so the image never has to be read back to be checked
+            # An image of known, modest size is collected in memory and written with a single call,
+            # instead of one write per chunk to what may be slow media.
+            memory_buffer = bytearray() if total_size and total_size <= FIRMWARE_MEMORY_BUFFER_LIMIT else None
+            write_chunk = memory_buffer.extend if memory_buffer is not None else tmp_file.write
+            preallocated = False
+            if total_size and hasattr(os, "posix_fallocate"):
+                # Reserve the whole file up front so the filesystem allocates it once, ideally contiguously
+                try: os.posix_fallocate(tmp_file.fileno(), 0, total_size); preallocated = True
+                except OSError: pass
+            if show_progress: sys.stdout.write("Downloading: ["); sys.stdout.flush()
+            read_buffer = bytearray(chunk_size); read_view = memoryview(read_buffer) # Reused, not a new bytes object per read
+            while True:
+                read_count = response.readinto(read_buffer)
+                if not read_count: break
+                chunk = read_view[:read_count]
+                write_chunk(chunk); file_hash.update(chunk); downloaded_size += read_count
+                if not show_progress: continue
+                if total_size:
+                    current_progress_pct = (downloaded_size / total_size) * 100
+                    if int(current_progress_pct / 5) > progress_ticks:
+                        sys.stdout.write("#"); sys.stdout.flush(); progress_ticks = int(current_progress_pct / 5)
+                elif downloaded_size // (chunk_size * 10) > progress_ticks:
+                    sys.stdout.write("."); sys.stdout.flush(); progress_ticks +=1
+            if memory_buffer is not None: tmp_file.write(memory_buffer)
+            if preallocated: tmp_file.truncate() # In case the server sent less than Content-Length
+            if show_progress: sys.stdout.write("] Done.\n"); sys.stdout.flush()
+        if total_size and downloaded_size != total_size:
+            raise ValueError(f"Download incomplete: got {downloaded_size} of {total_size} bytes")
+        if not cache_file:
+            return tmp_file_name, True
+        os.replace(tmp_file_name, cache_file)
+        try: os.remove(cache_meta_file[:-len(".json")] + ".bin") # Same image under the earlier <url hash>.bin cache name
+        except OSError: pass
+        write_cache_file(cache_meta_file, {"url": firmware_url, "etag": response.getheader("ETag"), "last_modified": response.getheader("Last-Modified"), "sha256": file_hash.hexdigest()})
+        return cache_file, False
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached_meta:
+            cached_hash = hashlib.sha256()
+            try:
+                with open(cache_file, "rb") as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), b""):
+                        cached_hash.update(chunk)
+                cached_copy_ok = cached_meta.get("sha256") == cached_hash.hexdigest()
+            except OSError: # Removed or unreadable since the request was sent
+                cached_copy_ok = False
+            if cached_copy_ok:
+                print("Firmware unchanged since the last download, using the cached copy.")
+                return cache_file, False
+            print("Cached firmware is damaged, downloading it again...")
+            try: os.remove(cache_file)
+            except OSError: pass
+            return download_firmware(firmware_url, show_progress)
+        print(f"\nError downloading firmware: {e.reason}", file=sys.stderr)
+        print(f"HTTP Error Code: {e.code}", file=sys.stderr)
+    except urllib.error.URLError as e:
+        print(f"\nError downloading firmware: {e.reason}", file=sys.stderr)
+    except Exception as e:
+        print(f"\nAn unexpected error occurred during download: {e}", file=sys.stderr)
+    if tmp_file_name and os.path.exists(tmp_file_name): os.remove(tmp_file_name)
+    sys.exit(1)
+
+FLASH_WRITE_ARGS_TEMPLATE = ( # Only the {} slots vary between flashes
+    "--chip", "esp32c3", "--port", "{port}", "--baud", "{baud}",
+    "--before", "default_reset", "--after", "hard_reset",
+    "write_flash", "-z", "--flash_mode", "keep", "--flash_freq", "keep", "--flash_size", "detect",
+    "0x0", "{firmware_path}",
+)
+
+def build_flash_args(firmware_path, port, baud=DEFAULT_FLASH_BAUD, erase_all=False):
+    """
+    Returns the full esptool argv for writing a MicroPython image at offset 0x0.
+    -z compresses the image on the wire (the flasher stub inflates it on the chip), and the flash size
+    is detected so the image header matches the board. Flash mode and frequency are left as the image's
+    header sets them ("keep"), which is what the firmware was built for.
+    erase_all: Erase the whole flash first (-e) within the same esptool connection.
+    """
+    esptool_args = [arg.format(port=port, baud=baud, firmware_path=firmware_path) for arg in FLASH_WRITE_ARGS_TEMPLATE]
+    if erase_all: esptool_args.insert(esptool_args.index("write_flash") + 1, "-e")
+    return esptool_args
+
+ESPTOOL_CONNECT_FAILURE_MARKERS = ("A fatal error occurred: Could not connect to an Espressif device", "Failed to connect to ESP32-C3")
+
+def require_esptool():
+    """Exits with install instructions if esptool isn't installed."""
+    import importlib.util
+    if importlib.util.find_spec("esptool") is None: # Checking the module is instant; `esptool --version` spawned a process
+        print("Error: esptool is not installed (esptool is required for flashing).", file=sys.stderr)
+        print("You can install it with: pip install esptool")
+        sys.exit(1)
+
+def esptool_error_text(esptool_result, default_msg):
+    """
+    Returns what a failed esptool run said: its captured stdout and stderr together, since esptool prints its
+    fatal errors ("A fatal error occurred: ...") to stdout. Falls back to default_msg when nothing was captured.
+    """
+    if not esptool_result:
+        return default_msg
+    output_parts = [text.strip() for text in (esptool_result.stdout, esptool_result.stderr) if isinstance(text, str) and text.strip()]
+    return "\n".join(output_parts) or default_msg
+
+def write_firmware(firmware_path, port, baud_rate_str, erase_all=False, suppress_output=False, timeout=180):
+    """
+    Writes a firmware image with esptool. A write that fails at a rate above FALLBACK_FLASH_BAUD is retried
+    once at that rate (unless the bootloader couldn't be reached at all).
+    Returns (esptool process, error message); the message is only meaningful if the process failed, and includes
+    the captured output of that run.
+    """
+    write_result = run_esptool_command(build_flash_args(firmware_path, port, baud_rate_str, erase_all=erase_all), suppress_output=suppress_output, timeout=timeout)
+    err_msg = esptool_error_text(write_result, "Write flash command failed.")
+    if write_result and write_result.returncode != 0 and str(baud_rate_str).isdigit() and int(baud_rate_str) > int(FALLBACK_FLASH_BAUD) \
+       and not any(marker in err_msg for marker in ESPTOOL_CONNECT_FAILURE_MARKERS):
+        # Some USB-UART bridges or cables can't keep up with the faster rate; a slower retry is still quicker than giving up
+        print(f"Writing to {port} at baud {baud_rate_str} failed, retrying at {FALLBACK_FLASH_BAUD}...", file=sys.stderr)
+        write_result = run_esptool_command(build_flash_args(firmware_path, port, FALLBACK_FLASH_BAUD, erase_all=erase_all), suppress_output=suppress_output, timeout=timeout)
+        err_msg = esptool_error_text(write_result, "Write flash command failed.")
+    return write_result, err_msg
+
+def flash_to_ports(ports, firmware_source, baud_rate_str=DEFAULT_FLASH_BAUD, erase=True):
+    """
+    Flashes the same firmware to several devices at once. The image is downloaded once; each port then gets
+    its own esptool run (erase, unless erase is False, and write in one connection) and MicroPython check in a worker thread, since
+    the devices' serial links are independent. Prints each device's output as it finishes.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    print(f"\nIMPORTANT: Ensure all {len(ports)} ESP32-C3 boards ({', '.join(ports)}) are in bootloader mode.")
+    print("To do this: Unplug USB, press and HOLD the BOOT button, plug in USB, wait 2-3 seconds, then RELEASE BOOT button.")
+    require_esptool()
+    if input("Proceed with flashing? (yes/no): ").lower() != 'yes':
+        print("Flashing cancelled by user.")
+        sys.exit(0)
+
+    downloaded_temp_file = None
+    try:
+        if firmware_source.startswith("http://") or firmware_source.startswith("https://"):
+            print(f"Downloading firmware from: {firmware_source}")
+            firmware_path, is_temporary = download_firmware(firmware_source)
+            if is_temporary: downloaded_temp_file = firmware_path
+        else:
+            if not os.path.isfile(firmware_source):
+                print(f"Error: Local firmware file not found at '{firmware_source}'", file=sys.stderr)
+                sys.exit(1)
+            firmware_path = os.path.realpath(firmware_source)
+
+        def flash_port(port):
+            write_result, err_msg = write_firmware(firmware_path, port, baud_rate_str, erase_all=erase, suppress_output=True)
+            if not write_result or write_result.returncode != 0:
+                error_text = f"Error writing firmware. esptool said: {err_msg}" # err_msg already holds esptool's output
+                if any(marker in err_msg for marker in ESPTOOL_CONNECT_FAILURE_MARKERS):
+                    error_text += "\nThis commonly indicates the device is not in bootloader mode or a connection issue."
+                return False, "", error_text
+            output = write_result.stdout or ""
+            verified, msg = wait_for_micropython(port)
+            return verified, output + msg + "\n", "" if verified else "MicroPython verification failed."
+
+        print(f"Flashing {len(ports)} devices at baud {baud_rate_str}: {', '.join(ports)}...")
+        failed_ports = []
+        with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            futures = {executor.submit(flash_port, port): port for port in ports}
+            for future in as_completed(futures):
+                port, (ok, output, err_msg) = futures[future], future.result()
+                print(f"\n--- {port} ---")
+                print(output, end="")
+                if err_msg: print(err_msg, file=sys.stderr)
+                if not ok: failed_ports.append(port)
+    finally:
+        if downloaded_temp_file:
+            try: os.remove(downloaded_temp_file)
+            except OSError as e: print(f"Warning: Could not delete temporary firmware file {downloaded_temp_file}: {e}", file=sys.stderr)
+
+    if failed_ports:
+        print(f"\nFlashing failed on: {', '.join(sorted(failed_ports))}", file=sys.stderr)
+        sys.exit(1)
+    print(f"\nMicroPython flashed and verified on all {len(ports)} devices.")
+
+def cmd_flash(firmware_source, baud_rate_str=DEFAULT_FLASH_BAUD, erase=True, sequential=False):
+    """
+    erase: Erase the whole flash before writing. False only overwrites the sectors the image occupies, keeping
+    the rest (such as the filesystem), which is quicker for re-flashing during development.
+    sequential: Download a firmware URL before touching the device instead of while the flash is erased,
+    for USB-serial drivers that misbehave with both going on.
+    """
     global DEVICE_PORT
     if not DEVICE_PORT:
         print("Error: Device port not set. Cannot proceed with flashing.", file=sys.stderr)
@@ -854,11 +1811,7 @@ def cmd_flash(firmware_source, baud_rate_str="230400"):
     
     print("\nIMPORTANT: Ensure your ESP32-C3 is in bootloader mode.")
     print("To do this: Unplug USB, press and HOLD the BOOT button, plug in USB, wait 2-3 seconds, then RELEASE BOOT button.")
-    
-    try: run_esptool_command(["--version"], suppress_output=True, timeout=5) 
-    except SystemExit: 
-        print("You can install it with: pip install esptool")
-        sys.exit(1)
+    require_esptool()
 
     if input("Proceed with flashing? (yes/no): ").lower() != 'yes':
         print("Flashing cancelled by user.")
@@ -866,90 +1819,140 @@ def cmd_flash(firmware_source, baud_rate_str="230400"):
     
     actual_firmware_file_to_flash = None
     downloaded_temp_file = None
+    download_future = None
     try:
-        if firmware_source.startswith("http://") or firmware_source.startswith("https://"):
+        if (firmware_source.startswith("http://") or firmware_source.startswith("https://")) and erase and not sequential:
+            # The download and the flash erase are independent, so the download runs in the background
+            # while esptool erases. Its progress bar is off so it doesn't interleave with esptool's output.
+            print(f"Downloading firmware from: {firmware_source} (in the background)")
+            from concurrent.futures import ThreadPoolExecutor
+            download_executor = ThreadPoolExecutor(max_workers=1)
+            download_future = download_executor.submit(download_firmware, firmware_source, False)
+            download_executor.shutdown(wait=False)
+        elif firmware_source.startswith("http://") or firmware_source.startswith("https://"):
             print(f"Downloading firmware from: {firmware_source}")
-            try:
-                with urllib.request.urlopen(firmware_source) as response, \
-                     tempfile.NamedTemporaryFile(delete=False, suffix=".bin", mode='wb') as tmp_file:
-                    total_size = response.getheader('Content-Length')
-                    if total_size:
-                        total_size = int(total_size)
-                        print("File size:", total_size // 1024, "KB")
-                    else:
-                        print("File size: Unknown (Content-Length header not found)")
-                    downloaded_size = 0; chunk_size = 8192; progress_ticks = 0
-                    sys.stdout.write("Downloading: ["); sys.stdout.flush()
-                    while True:
-                        chunk = response.read(chunk_size)
-                        if not chunk: break
-                        tmp_file.write(chunk); downloaded_size += len(chunk)
-                        if total_size:
-                            current_progress_pct = (downloaded_size / total_size) * 100
-                            if int(current_progress_pct / 5) > progress_ticks:
-                                sys.stdout.write("#"); sys.stdout.flush(); progress_ticks = int(current_progress_pct / 5)
-                        elif downloaded_size // (chunk_size * 10) > progress_ticks:
-                            sys.stdout.write("."); sys.stdout.flush(); progress_ticks +=1
-                    sys.stdout.write("] Done.\n"); sys.stdout.flush()
-                    actual_firmware_file_to_flash = tmp_file.name
-                    downloaded_temp_file = actual_firmware_file_to_flash
-                print(f"Firmware downloaded successfully to temporary file: {actual_firmware_file_to_flash}")
-            except urllib.error.URLError as e:
-                print(f"\nError downloading firmware: {e.reason}", file=sys.stderr)
-                if hasattr(e, 'code'): print(f"HTTP Error Code: {e.code}", file=sys.stderr)
-                sys.exit(1)
-            except Exception as e:
-                print(f"\nAn unexpected error occurred during download: {e}", file=sys.stderr)
-                sys.exit(1)
+            actual_firmware_file_to_flash, is_temporary = download_firmware(firmware_source)
+            firmware_name = os.path.basename(actual_firmware_file_to_flash)
+            if is_temporary: downloaded_temp_file = actual_firmware_file_to_flash
         else:
-            local_firmware_path = Path(firmware_source)
-            if not local_firmware_path.is_file():
-                print(f"Error: Local firmware file not found at '{local_firmware_path}'", file=sys.stderr)
+            if not os.path.isfile(firmware_source):
+                print(f"Error: Local firmware file not found at '{firmware_source}'", file=sys.stderr)
                 sys.exit(1)
-            actual_firmware_file_to_flash = str(local_firmware_path.resolve()) 
+            actual_firmware_file_to_flash = os.path.realpath(firmware_source)
+            firmware_name = os.path.basename(actual_firmware_file_to_flash)
             print(f"Using local firmware file: {actual_firmware_file_to_flash}")
         
         esptool_timeout = 180
-        print(f"\nStep 1: Erasing flash on {DEVICE_PORT}...")
-        erase_args = ["--chip", "esp32c3", "--port", DEVICE_PORT, "erase_flash"]
-        erase_result = run_esptool_command(erase_args, timeout=esptool_timeout) 
-        if not erase_result or erase_result.returncode != 0:
-            err_msg = erase_result.stderr.strip() if erase_result and erase_result.stderr else "Erase command failed."
-            print(f"Error erasing flash. esptool said: {err_msg}", file=sys.stderr)
-            if "A fatal error occurred: Could not connect to an Espressif device" in err_msg or \
-               "Failed to connect to ESP32-C3" in err_msg :
-                 print("This commonly indicates the device is not in bootloader mode or a connection issue.", file=sys.stderr)
-            sys.exit(1)
-        print("Flash erase completed successfully.")
+        # A separate erase is only worth its own esptool connection (sync + stub upload) while a download
+        # runs alongside it; otherwise write_flash -e erases within the write's connection.
+        erase_separately = download_future is not None
+        if erase_separately:
+            print(f"\nStep 1: Erasing flash on {DEVICE_PORT}...")
+            erase_args = ["--chip", "esp32c3", "--port", DEVICE_PORT, "--baud", baud_rate_str, "erase_flash"]
+            erase_result = run_esptool_command(erase_args, timeout=esptool_timeout) 
+            if not erase_result or erase_result.returncode != 0:
+                err_msg = esptool_error_text(erase_result, "Erase command failed.")
+                print(f"Error erasing flash. esptool said: {err_msg}", file=sys.stderr)
+                if any(marker in err_msg for marker in ESPTOOL_CONNECT_FAILURE_MARKERS):
+                     print("This commonly indicates the device is not in bootloader mode or a connection issue.", file=sys.stderr)
+                sys.exit(1)
+            print("Flash erase completed successfully.")
+            if not download_future.done(): print("Waiting for the firmware download to finish...")
+            actual_firmware_file_to_flash, is_temporary = download_future.result()
+            firmware_name = os.path.basename(actual_firmware_file_to_flash)
+            if is_temporary: downloaded_temp_file = actual_firmware_file_to_flash
+            print(f"Firmware downloaded successfully to: {actual_firmware_file_to_flash}")
+            print(f"\nStep 2: Writing firmware '{firmware_name}' to {DEVICE_PORT} at baud {baud_rate_str}...")
+        elif erase:
+            print(f"\nStep 1-2: Erasing flash and writing firmware '{firmware_name}' to {DEVICE_PORT} at baud {baud_rate_str}...")
+        else:
+            print(f"\nStep 1: Skipped flash erase (--no-erase).\nStep 2: Writing firmware '{firmware_name}' to {DEVICE_PORT} at baud {baud_rate_str}...")
         
-        print(f"\nStep 2: Writing firmware '{Path(actual_firmware_file_to_flash).name}' to {DEVICE_PORT} at baud {baud_rate_str}...")
-        write_args = ["--chip", "esp32c3", "--port", DEVICE_PORT, "--baud", baud_rate_str, "write_flash", "-z", "0x0", actual_firmware_file_to_flash]
-        write_result = run_esptool_command(write_args, timeout=esptool_timeout)
+        write_result, err_msg = write_firmware(actual_firmware_file_to_flash, DEVICE_PORT, baud_rate_str, erase_all=erase and not erase_separately, timeout=esptool_timeout)
         if not write_result or write_result.returncode != 0:
-            err_msg = write_result.stderr.strip() if write_result and write_result.stderr else "Write flash command failed."
             print(f"Error writing firmware. esptool said: {err_msg}", file=sys.stderr)
+            if any(marker in err_msg for marker in ESPTOOL_CONNECT_FAILURE_MARKERS):
+                 print("This commonly indicates the device is not in bootloader mode or a connection issue.", file=sys.stderr)
             sys.exit(1)
         print("Firmware writing completed successfully.")
         
         print("\nStep 3: Verifying MicroPython installation...")
-        print("Waiting a few seconds for device to reboot...")
-        time.sleep(5) 
-        verified, msg = test_micropython_presence(DEVICE_PORT, timeout=MP_TIMEOUT_EXEC + 5)
+        verified, msg = wait_for_micropython(DEVICE_PORT)
         print(msg)
         if not verified:
             print("MicroPython verification failed.", file=sys.stderr)
             sys.exit(1)
         print("\nMicroPython flashed and verified successfully!")
     finally:
+        if download_future and not actual_firmware_file_to_flash:
+            # Flashing stopped before the download was collected; let it finish so a temporary file can be removed
+            try:
+                firmware_path, is_temporary = download_future.result()
+                if is_temporary: downloaded_temp_file = firmware_path
+            except BaseException: pass
         if downloaded_temp_file:
             try: os.remove(downloaded_temp_file)
             except OSError as e: print(f"Warning: Could not delete temporary firmware file {downloaded_temp_file}: {e}", file=sys.stderr)
 
 
-def main():
-    global DEVICE_PORT
-    cfg = load_config()
-    
+_ERR_NO_PORT = "Error: No COM port selected or configured.\nUse 'esp32 devices' to list available ports, then 'esp32 device <PORT_NAME>' to set one."
+def _selected_command(argv):
+    """Returns the command named on the command line (skipping --port/-p and its value), or None if there is none."""
+    skip_next = False
+    for token in argv:
+        if skip_next: skip_next = False
+        elif token in ("--port", "-p"): skip_next = True
+        elif token.startswith("--port=") or (token.startswith("-p") and not token.startswith("--")): continue
+        elif token.startswith("-"): return None # e.g. -h before any command
+        else: return token if token in COMMANDS else None
+    return None
+
+def add_command_parser(subparsers, name):
+    """Adds the argparse subparser for one command."""
+    if name == "help":
+        subparsers.add_parser("help", help="Show this help message and exit.")
+    elif name == "devices":
+        devices_parser = subparsers.add_parser("devices",help="List available COM ports and show the selected COM port.")
+        devices_parser.add_argument("--all", "-a", action="store_true", help="Also list ports that don't look like an ESP32 USB-serial adapter.")
+    elif name == "device":
+        dev_parser = subparsers.add_parser("device", help="Set or test the selected COM port for operations.")
+        dev_parser.add_argument("port_name", nargs='?', metavar="PORT", help="The COM port to set. If omitted, tests current.")
+        dev_parser.add_argument("--force", "-f", action="store_true", help="Force set port even if test fails.")
+        dev_parser.add_argument("--no-cache", action="store_true", help=f"Always test the device, instead of reusing a successful result from the last {TEST_DEVICE_CACHE_TTL} seconds.")
+    elif name == "flash":
+        flash_parser = subparsers.add_parser("flash", help="Download (if URL) and flash MicroPython firmware to the ESP32.")
+        flash_parser.add_argument("firmware_source", default=DEFAULT_FIRMWARE_URL, nargs='?', help="URL or local path for firmware .bin. Default: official ESP32_GENERIC_C3")
+        flash_parser.add_argument("--baud", default=None, help=f"Baud rate for flashing. Saved as the default for later flashes (Default: {DEFAULT_FLASH_BAUD}).")
+        flash_parser.add_argument("--ports", default=None, metavar="PORT[,PORT...]", help="Comma-separated ports to flash in parallel, one device per port (instead of the selected port).")
+        flash_parser.add_argument("--sequential", action="store_true", help="Download the firmware before erasing instead of in the background while erasing (for USB-serial drivers that misbehave with both at once).")
+        flash_parser.add_argument("--no-erase", action="store_true", help="Don't erase the whole flash first; only the image's sectors are overwritten, keeping the rest (such as the filesystem with your files).")
+    elif name == "upload":
+        up_parser = subparsers.add_parser("upload", help="Upload file/directory to ESP32. Iterative with delays.")
+        up_parser.add_argument("local_source", help="Local file/dir. Trailing '/' on dir (e.g. 'mydir/') uploads contents. No trailing slash (e.g. 'mydir') uploads dir itself.")
+        up_parser.add_argument("remote_destination", nargs='?', default=None, help="Remote parent directory path (e.g. '/lib'). If omitted, uploads to device root.")
+        up_parser.add_argument("--ports", default=None, metavar="PORT[,PORT...]", help="Comma-separated ports to upload to in parallel, one device per port (instead of the selected port).")
+        up_parser.add_argument("--skip-dev-files", action="store_true", help="When uploading a directory, leave out hidden entries (e.g. .git), __pycache__, *.egg-info and this tool's config file. Skipped entries are listed.")
+    elif name == "download":
+        dl_parser = subparsers.add_parser("download", help="Download file/directory from ESP32. Iterative with delays.")
+        dl_parser.add_argument("remote_source_path", metavar="REMOTE_PATH", help="Remote file/dir path. Trailing '/' on dir (e.g., '/logs/', '//' for root contents) downloads its contents. No trailing slash (e.g. '/logs') downloads the directory itself.")
+        dl_parser.add_argument("local_target_path", nargs='?', default=None, metavar="LOCAL_PATH", help="Local directory to download into, or local filename for a single remote file. If omitted, uses current directory.")
+    elif name == "run":
+        run_parser = subparsers.add_parser("run", help="Run Python script on ESP32.")
+        run_parser.add_argument("script_name", nargs='?', default="main.py", metavar="SCRIPT", help="Script to run (default: main.py). Path relative to device root.")
+    elif name == "list":
+        list_parser = subparsers.add_parser("list", help="List files/dirs on ESP32 (recursively from given path).") 
+        list_parser.add_argument("remote_directory", nargs='?', default=None, metavar="REMOTE_DIR", help="Remote directory path (e.g., '/lib', or omit for root).")
+    elif name == "tree":
+        tree_parser = subparsers.add_parser("tree", help="Display remote file tree.")
+        tree_parser.add_argument("remote_directory", nargs='?', default=None, metavar="REMOTE_DIR", help="Remote directory path (default: root).")
+    elif name == "delete":
+        del_parser = subparsers.add_parser("delete", help="Delete file/directory on ESP32. Uses recursive delete with delays.")
+        del_parser.add_argument("remote_path_to_delete", metavar="REMOTE_PATH", nargs='?', default=None, help="Remote path (e.g. '/main.py', '/lib'). Omitting or '/' deletes root contents (requires confirmation).")
+    elif name == "diagnostics":
+        subparsers.add_parser("diagnostics", help="Run diagnostic commands on the ESP32 device.")
+
+def _build_parser(selected_cmd=None):
+    """Builds the CLI parser, with only selected_cmd's subparser when a known command was given."""
     parser = argparse.ArgumentParser(
         prog="esp32",
         description="Manage deployment of MicroPython files to an ESP32 device via mpremote. Also supports flashing MicroPython firmware.",
@@ -958,75 +1961,73 @@ def main():
     parser.add_argument("--port", "-p", help="Override default/configured COM port for this command instance.")
     subparsers = parser.add_subparsers(dest="cmd", required=True, title="Available commands", metavar="<command>")
 
-    subparsers.add_parser("help", help="Show this help message and exit.")
-    subparsers.add_parser("devices",help="List available COM ports and show the selected COM port.")
-    
-    dev_parser = subparsers.add_parser("device", help="Set or test the selected COM port for operations.")
-    dev_parser.add_argument("port_name", nargs='?', metavar="PORT", help="The COM port to set. If omitted, tests current.")
-    dev_parser.add_argument("--force", "-f", action="store_true", help="Force set port even if test fails.")
-    
-    flash_parser = subparsers.add_parser("flash", help="Download (if URL) and flash MicroPython firmware to the ESP32.")
-    flash_parser.add_argument("firmware_source", default=DEFAULT_FIRMWARE_URL, nargs='?', help=f"URL or local path for firmware .bin. Default: official ESP32_GENERIC_C3")
-    flash_parser.add_argument("--baud", default="230400", help="Baud rate for flashing (Default: 230400).")
-    
-    up_parser = subparsers.add_parser("upload", help="Upload file/directory to ESP32. Iterative with delays.")
-    up_parser.add_argument("local_source", help="Local file/dir. Trailing '/' on dir (e.g. 'mydir/') uploads contents. No trailing slash (e.g. 'mydir') uploads dir itself.")
-    up_parser.add_argument("remote_destination", nargs='?', default=None, help="Remote parent directory path (e.g. '/lib'). If omitted, uploads to device root.")
-    
-    dl_parser = subparsers.add_parser("download", help="Download file/directory from ESP32. Iterative with delays.")
-    dl_parser.add_argument("remote_source_path", metavar="REMOTE_PATH", help="Remote file/dir path. Trailing '/' on dir (e.g., '/logs/', '//' for root contents) downloads its contents. No trailing slash (e.g. '/logs') downloads the directory itself.")
-    dl_parser.add_argument("local_target_path", nargs='?', default=None, metavar="LOCAL_PATH", help="Local directory to download into, or local filename for a single remote file. If omitted, uses current directory.")
+    # Only the chosen command's arguments matter, so skip building the other subparsers.
+    # Top-level help, "help" and unrecognised input get them all, for the full command list and error messages.
+    for name in COMMANDS if selected_cmd in (None, "help") else (selected_cmd,):
+        add_command_parser(subparsers, name)
+    return parser
 
-    run_parser = subparsers.add_parser("run", help="Run Python script on ESP32.")
-    run_parser.add_argument("script_name", nargs='?', default="main.py", metavar="SCRIPT", help="Script to run (default: main.py). Path relative to device root.")
-    
-    list_parser = subparsers.add_parser("list", help="List files/dirs on ESP32 (recursively from given path).") 
-    list_parser.add_argument("remote_directory", nargs='?', default=None, metavar="REMOTE_DIR", help="Remote directory path (e.g., '/lib', or omit for root).")
-    
-    tree_parser = subparsers.add_parser("tree", help="Display remote file tree.")
-    tree_parser.add_argument("remote_directory", nargs='?', default=None, metavar="REMOTE_DIR", help="Remote directory path (default: root).")
-    
-    del_parser = subparsers.add_parser("delete", help="Delete file/directory on ESP32. Uses recursive delete with delays.")
-    del_parser.add_argument("remote_path_to_delete", metavar="REMOTE_PATH", nargs='?', default=None, help="Remote path (e.g. '/main.py', '/lib'). Omitting or '/' deletes root contents (requires confirmation).")
-    
-    subparsers.add_parser("diagnostics", help="Run diagnostic commands on the ESP32 device.")
+def flash_with_saved_baud(args):
+    cfg = load_config()
+    if args.baud and args.baud != cfg.get("baud"):
+        cfg["baud"] = args.baud
+        save_config(cfg)
+    baud_rate_str = args.baud or cfg.get("baud", DEFAULT_FLASH_BAUD)
+    if args.ports: flash_to_ports(parse_port_list(args.ports), args.firmware_source, baud_rate_str, not args.no_erase)
+    else: cmd_flash(args.firmware_source, baud_rate_str, not args.no_erase, args.sequential)
+
+def device_command(args):
+    if args.port_name:
+        cmd_device(args.port_name, args.force, not args.no_cache)
+    elif DEVICE_PORT:
+        print(f"Current selected COM port is {DEVICE_PORT}. Testing...")
+        ok, msg = test_device_cached(DEVICE_PORT, not args.no_cache)
+        print(msg)
+    else:
+        print("No COM port currently selected or configured.")
+        cmd_devices()
+        probe_candidate_ports()
+        print("\nUse 'esp32 device <PORT_NAME>' to set one.")
+
+def upload_command(args):
+    if args.ports:
+        upload_to_ports(parse_port_list(args.ports), args.local_source, args.remote_destination, args.skip_dev_files)
+    else:
+        cmd_upload(args.local_source, args.remote_destination, args.skip_dev_files)
+
+# Command name -> (handler called as handler(args), whether the command can't run without a port).
+# "device" handles a missing port itself, and "flash" reports it after its own instructions.
+# Also the order commands are listed in by the help.
+COMMANDS = {
+    "help": (lambda args: _build_parser().print_help(), False),
+    "devices": (lambda args: cmd_devices(args.all), False),
+    "device": (device_command, False),
+    "flash": (flash_with_saved_baud, False),
+    "upload": (upload_command, True),
+    "download": (lambda args: cmd_download(args.remote_source_path, args.local_target_path), True),
+    "run": (lambda args: run_script(args.script_name), True),
+    "list": (lambda args: list_remote(args.remote_directory), True),
+    "tree": (lambda args: tree_remote(args.remote_directory), True),
+    "delete": (lambda args: delete_remote(args.remote_path_to_delete), True),
+    "diagnostics": (lambda args: cmd_diagnostics(), True),
+}
+
+def main():
+    global DEVICE_PORT
     
+    parser = _build_parser(_selected_command(sys.argv[1:]))
     args = parser.parse_args()
 
+    handler, needs_port = COMMANDS[args.cmd]
     if args.port: DEVICE_PORT = args.port
-    elif "port" in cfg: DEVICE_PORT = cfg["port"]
-    
-    commands_needing_port = [
-        "device", "upload", "run", "list", "tree", 
-        "download", "delete", "flash", "diagnostics" 
-    ]
-    is_device_command_setting_port = args.cmd == "device" and args.port_name
+    elif args.cmd != "help": # The config is only read when something needs it
+        cfg = load_config()
+        if "port" in cfg: DEVICE_PORT = resolve_configured_port(cfg) if needs_port or args.cmd == "flash" else cfg["port"]
     
-    if args.cmd in commands_needing_port and not DEVICE_PORT and not is_device_command_setting_port:
-        if args.cmd == "device" and not args.port_name: pass 
-        elif args.cmd == "flash" and not DEVICE_PORT: pass
-        else:
-            print("Error: No COM port selected or configured.", file=sys.stderr)
-            print("Use 'esp32 devices' to list available ports, then 'esp32 device <PORT_NAME>' to set one.", file=sys.stderr)
-            sys.exit(1)
-
-    if args.cmd == "help": parser.print_help()
-    elif args.cmd == "devices": cmd_devices()
-    elif args.cmd == "device":
-        if args.port_name: cmd_device(args.port_name, args.force)
-        elif DEVICE_PORT: 
-            print(f"Current selected COM port is {DEVICE_PORT}. Testing...")
-            ok, msg = test_device(DEVICE_PORT); print(msg)
-        else: 
-            print("No COM port currently selected or configured."); cmd_devices(); print(f"\nUse 'esp32 device <PORT_NAME>' to set one.")
-    elif args.cmd == "flash": cmd_flash(args.firmware_source, args.baud)
-    elif args.cmd == "upload": cmd_upload(args.local_source, args.remote_destination)
-    elif args.cmd == "run": run_script(args.script_name)
-    elif args.cmd == "list": list_remote(args.remote_directory)
-    elif args.cmd == "tree": tree_remote(args.remote_directory)
-    elif args.cmd == "download": cmd_download(args.remote_source_path, args.local_target_path)
-    elif args.cmd == "delete": delete_remote(args.remote_path_to_delete)
-    elif args.cmd == "diagnostics": cmd_diagnostics() 
+    if not DEVICE_PORT and needs_port and not getattr(args, "ports", None):
+        print(_ERR_NO_PORT, file=sys.stderr)
+        sys.exit(1)
+    handler(args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file